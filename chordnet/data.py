@@ -1,27 +1,29 @@
 import torch
 from torch import Tensor
-from torch.utils.data import DataLoader, TensorDataset, random_split
+from torch.utils.data import DataLoader, TensorDataset
 from torch.nn.utils.rnn import pad_sequence
-from scipy.io import wavfile as wav
-from scipy.fftpack import dct
+from scipy.fft import dct
 import numpy as np
-import copy
 import zipfile
 import re
 import sys
+import time
 import pickle
+import multiprocessing
 import pytorch_lightning as pl
 import pychord
 import random
 from tabulate import tabulate
 import librosa
-from typing import List, Dict
+from typing import List, Dict, Optional, Sequence
 
 from dataclasses import dataclass
 
-from chordnet.utils import dirs, file_utils, music_utils, annotation_utils
+from chordnet.utils import dirs, file_utils, music_utils, annotation_utils, spectra_utils, \
+    cache_utils, store_utils
 from chordnet.utils.data_utils import DatasetType
 from chordnet.utils.music_utils import Chord, ChordEncoding
+from chordnet.utils.audio_utils import Audio
 from chordnet.utils.tempo import TempoDetector
 
 import pdb
@@ -33,11 +35,22 @@ class DataProperties():
     bin_n: int # Bins per octave
 
 class ListDataset(torch.utils.data.Dataset):
-    def __init__(self, signals: List[Tensor], targets: List[Tensor], metadatas: List[Dict]):
+    def __init__(self, signals: Sequence[Tensor], targets: Sequence[Tensor],
+                 metadatas: List[Dict], lengths: Optional[List[int]] = None):
+        """A dataset of (signal, target, metadata) songs.
+
+        Arguments:
+            signals: T x * tensors of the songs.
+            targets: T x 2 tensors of the songs.
+            metadatas: metadata dicts of the songs.
+            lengths: beats of every song, e.g. from the feature store offsets. Read from the
+                targets if not given.
+        """
         assert len(signals) == len(targets) == len(metadatas)
         self.signals = signals
         self.targets = targets
         self.metadatas = metadatas
+        self.song_lengths = lengths
 
     def __getitem__(self, index):
         return self.signals[index], self.targets[index], self.metadatas[index]
@@ -45,38 +58,221 @@ class ListDataset(torch.utils.data.Dataset):
     def __len__(self):
         return len(self.signals)
 
+    def lengths(self) -> List[int]:
+        """Beats of every item, without loading any."""
+        if self.song_lengths is None:
+            return [len(target) for target in self.targets]
+        return list(self.song_lengths)
+
+class ChunkedDataset(torch.utils.data.Dataset):
+    def __init__(self, dataset, chunk_len: int, margin: int):
+        """Cuts every song of a dataset into overlapping windows of at most chunk_len beats.
+
+        Every chunk scores a core of chunk_len - 2 * margin beats. The margin beats on either
+        side of the core give the model its context and have CONTEXT targets, so they are left
+        out of the loss. The cores of the chunks of a song tile the whole song, and there are no
+        margins past the ends of the song. Chunks are sliced on access.
+
+        Cores are cut at fixed beat offsets, not at chord changes, so a chord may be scored
+        partly in one chunk and partly in the next. The signal and targets of a chunk are sliced
+        from the same frames. Like whole songs, a chunk of T frames keeps the T - 1 beats between
+        its frames, and its metadata gets a start_time for the start of its first frame.
+
+        Arguments:
+            dataset: dataset of (signal, target, metadata) songs.
+            chunk_len: maximum beats per chunk.
+            margin: context beats on either side of the scored core.
+        """
+        assert chunk_len > 2 * margin
+        self.dataset = dataset
+        self.margin = margin
+        core_len = chunk_len - 2 * margin
+
+        # (song index, core start, core end) of every chunk
+        self.song_lengths = dataset.lengths()
+        self.chunks = []
+        for (i, song_len) in enumerate(self.song_lengths):
+            self.chunks += [(i, start, min(start + core_len, song_len))
+                            for start in range(0, song_len, core_len)]
+
+    def __getitem__(self, index):
+        i, core_start, core_end = self.chunks[index]
+        signal, target, metadata = self.dataset[i]
+        start = max(core_start - self.margin, 0)
+        end = min(core_end + self.margin, len(target))
+
+        target = target[start:end].clone()
+        target[:core_start - start] = music_utils.CONTEXT
+        target[core_end - start:] = music_utils.CONTEXT
+
+        # Frame j of a song starts at ([0.0] + beats)[j]
+        metadata = dict(metadata, song=f'{metadata["song"]} [{start}:{end}]',
+                        beats=metadata['beats'][start:end - 1],
+                        start_time=([0.0] + list(metadata['beats']))[start])
+        return signal[start:end], target, metadata
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def lengths(self) -> List[int]:
+        """Beats of every chunk including its margins, without loading any."""
+        return [min(core_end + self.margin, self.song_lengths[i]) - max(core_start - self.margin, 0)
+                for (i, core_start, core_end) in self.chunks]
+
+class TransposedDataset(torch.utils.data.Dataset):
+    def __init__(self, dataset, shifts: Sequence[int], props: DataProperties,
+                 random_shift=False):
+        """Views a dataset of songs transposed by some semitone shifts.
+
+        Songs are stored once and transposed on access: the signal is the octave_n octave view
+        shifted by shift notes out of the extra octave on either side, and the roots are shifted
+        down by shift. Song names get a ' (+shift)' suffix.
+
+        Arguments:
+            dataset: dataset of (signal, target, metadata) songs with one extra octave of bins on
+                either side of the signals.
+            shifts: semitone shifts, at most one octave either way.
+            props: properties of the data, for the bins and the chord encoding.
+            random_shift: if true, every song appears once with a shift drawn on every access,
+                so each epoch sees a new transposition at the cost of one. Otherwise every song
+                appears once per shift, ordered by shift.
+        """
+        self.dataset = dataset
+        self.shifts = list(shifts)
+        self.props = props
+        self.random_shift = random_shift
+
+    def __getitem__(self, index):
+        if self.random_shift:
+            shift = random.choice(self.shifts)
+        else:
+            shift = self.shifts[index // len(self.dataset)]
+            index = index % len(self.dataset)
+        signal, target, metadata = self.dataset[index]
+
+        bin_n, bins_per_note = self.props.bin_n, self.props.bin_n // 12
+        signal = signal[:, bin_n + shift * bins_per_note : -bin_n + shift * bins_per_note]
+
+        roots, qualities = target[:, 0], target[:, 1]
+        is_chord = roots != music_utils.NO_ENCODING
+        if self.props.encoding.qualities[0] == 'N':
+            is_chord = is_chord & (qualities != 0)
+        target = torch.stack([torch.where(is_chord, (roots - shift) % 12, roots), qualities], 1)
+
+        metadata = dict(metadata, song=f'{metadata["song"]} ({shift:+})')
+        return signal, target, metadata
+
+    def __len__(self):
+        if self.random_shift:
+            return len(self.dataset)
+        return len(self.shifts) * len(self.dataset)
+
+    def lengths(self) -> List[int]:
+        """Beats of every item, without loading or transposing any."""
+        if self.random_shift:
+            return self.dataset.lengths()
+        return len(self.shifts) * self.dataset.lengths()
+
 def pad_collate(batch):
+    """Pads a batch of songs to B x T x * tensors.
+
+    Returns:
+        signals, targets, metadatas and a B tensor of the song lengths, so consumers never have
+        to rediscover the padding.
+    """
     signals = [data[0] for data in batch]
     targets = [data[1] for data in batch]
     metadatas = [data[2] for data in batch]
+    lengths = torch.tensor([len(target) for target in targets], dtype=torch.long)
 
     signals = pad_sequence(signals, batch_first=True, padding_value=music_utils.PADDED)
     targets = pad_sequence(targets, batch_first=True, padding_value=music_utils.PADDED)
 
-    return signals, targets, metadatas
+    return signals, targets, metadatas, lengths
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    def __init__(self, lengths: Sequence[int], batch_size: int, boundaries: Sequence[int],
+                 shuffle=True, seed=0):
+        """Batches songs of similar length together to keep padding small.
+
+        Songs are put into buckets by their beat count, with bucket i holding the songs of
+        length in [boundaries[i - 1], boundaries[i]). Batches never mix buckets. Every epoch the
+        songs are shuffled inside their buckets and the order of the batches is shuffled.
+
+        Arguments:
+            lengths: beat count of every song in the dataset.
+            batch_size: maximum songs per batch. The last batch of a bucket may be smaller.
+            boundaries: increasing beat counts separating the buckets.
+            shuffle: if false, batches are sorted by bucket and keep the dataset order.
+            seed: seeds the shuffling, successive epochs draw different orders.
+        """
+        assert list(boundaries) == sorted(boundaries)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = random.Random(seed)
+
+        bucket_ids = np.searchsorted(boundaries, lengths, side='right')
+        self.buckets = [list(np.flatnonzero(bucket_ids == bucket))
+                        for bucket in range(len(boundaries) + 1)]
+        self.buckets = [[int(i) for i in bucket] for bucket in self.buckets if len(bucket) > 0]
+
+    def __iter__(self):
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = self.rng.sample(bucket, len(bucket))
+            batches += [bucket[i:i + self.batch_size]
+                        for i in range(0, len(bucket), self.batch_size)]
+
+        if self.shuffle:
+            self.rng.shuffle(batches)
+        # A generator only draws the epoch's order once iterated, multi-process DataLoaders
+        # create and discard a first iterator
+        yield from batches
+
+    def __len__(self):
+        return sum((len(bucket) + self.batch_size - 1) // self.batch_size
+                   for bucket in self.buckets)
 
 class ChordDataModule(pl.LightningDataModule):
     MISTIMING_THRESHOLD = 0.5 # Fraction of beat duration we're okay mistiming
     START_OCTAVE = -4
-
-    def __init__(self, dataset_type, fetch_data, file_filter='',
-                 augment=False, batch_size=1, split=[0.60, 0.25, 0.15]):
+    SUBWINDOW_N = 10 # Random subwindows averaged into every beat spectrum
+    CQT_HOP = 512 # Spectrogram hop in samples for the cqt extractor
+    FEATURES_VERSION = 3 # Bump whenever extraction changes to invalidate cached chromas
+    BEAT_CACHE_BYTES = 64 << 20 # Least recently used beat detections are evicted past this size
+    BUCKET_BOUNDARIES = [200, 300, 400, 500, 600, 800] # Beat counts separating training buckets
+    CHUNK_MARGIN = 5 # Context beats around training chunks, ChordNet looks 5 beats either way
+    EXTRACTORS = ['dct', 'cqt']
+
+    def __init__(self, dataset_type, fetch_data, file_filter='', augment=False,
+                 random_shift=False, batch_size=1, split=[0.60, 0.25, 0.15], extractor=None,
+                 workers=1, seed=0, store_dtype=np.float32, bucket_boundaries=None,
+                 chunk_len=None, chunk_margin=None, loader_workers=0, persistent_workers=True,
+                 prefetch_factor=2, pin_memory=False, loader_context=None):
         super().__init__()
 
+        metadata = self.read_metadata()
         if dataset_type is None:
-            metadata = self.read_metadata()
             if metadata is None:
                 raise RuntimeError('Must specify data type!')
             dataset_type = metadata['dataset_type']
-            print(f'Loaded dataset type: {dataset_type}')
+            print(f'Loaded dataset type: {dataset_type}, '
+                  f'extractor: {self.stored_extractor(metadata)}')
             self.load_dataset = False
         else:
             if not fetch_data:
-                # Make sure right metadata is there if previous fetch was aborted or similar
-                self.write_metadata({'dataset_type': dataset_type})
+                # Make sure right metadata is there if previous fetch was aborted or similar.
+                # Only a fetch (re)extracts features, so the stored extractor is kept
+                kept = {} if metadata is None else {'extractor': self.stored_extractor(metadata)}
+                self.write_metadata({'dataset_type': dataset_type, **kept})
 
             self.load_dataset = fetch_data
 
+        if extractor is None:
+            # Defaults to the extractor of the stored features unless they are fetched anew
+            extractor = 'dct' if (self.load_dataset or metadata is None) \
+                        else self.stored_extractor(metadata)
 
         encodings = {
             DatasetType.GENERATED:                  music_utils.GeneratedEncoding(),
@@ -92,34 +288,55 @@ class ChordDataModule(pl.LightningDataModule):
         self.props = DataProperties(encodings[dataset_type], octave_n=7, bin_n=24)
         self.file_filter = file_filter
         self.augment = augment
+        self.random_shift = random_shift # Augment with one random shift per song and epoch
         self.batch_size = batch_size
         self.split = split
 
+        assert extractor in self.EXTRACTORS
+        self.extractor = extractor
+        self.workers = workers # Processes used to parse spectra on fetch
+        # DataLoader worker processes, forked workers share the memory maps of the feature store
+        # and spawned ones map it again
+        self.loader_workers = loader_workers
+        self.loader_context = loader_context # Start method of the workers, e.g. 'spawn'
+        self.persistent_workers = persistent_workers # Keep workers alive between epochs
+        self.prefetch_factor = prefetch_factor # Batches loaded ahead by every worker
+        self.pin_memory = pin_memory # Page-lock batches for faster copies to the GPU
+        self.seed = seed # Seeds the random subwindows of every song
+        self.store_dtype = store_dtype # float32 or float16 features in the feature store
+        # Training batches only mix songs between neighbouring boundaries, see BucketBatchSampler
+        self.bucket_boundaries = self.BUCKET_BOUNDARIES if bucket_boundaries is None \
+                                 else bucket_boundaries
+        # Train on chunks of chunk_len beats instead of whole songs if set, see ChunkedDataset
+        self.chunk_len = chunk_len
+        self.chunk_margin = self.CHUNK_MARGIN if chunk_margin is None else chunk_margin
+        self.cache = cache_utils.FeatureCache(size_limits={'beats': self.BEAT_CACHE_BYTES})
+
 
     def prepare_data(self):
         if self.load_dataset:
             print('Fetching dataset...')
-            dataset_file = {
-                DatasetType.GENERATED:                  'generated.zip',
-                DatasetType.BILLBOARD_MAJMIN_TINY:      'billboard-tiny.zip',
-                DatasetType.BILLBOARD_MAJMIN7_TINY:     'billboard-tiny.zip',
-                DatasetType.BILLBOARD_MAJMIN_SMALL:     'billboard-small.zip',
-                DatasetType.BILLBOARD_MAJMIN7_SMALL:    'billboard-small.zip',
-                DatasetType.BILLBOARD_MAJMIN_ALL:       'billboard-all.zip',
-                DatasetType.BILLBOARD_MAJMIN7_ALL:      'billboard-all.zip'
-            }.get(self.dataset_type)
-
-            dataset_zip = dirs.root_path('misc', 'data_zips', dataset_file)
-
             file_utils.create_empty_directory(dirs.data_path())
-            with zipfile.ZipFile(dataset_zip, 'r') as zip_ref:
-                zip_ref.extractall(dirs.data_path())
 
+            # Audio is streamed straight from the zip, only the feature store is written to disk
             print('Parsing spectra...')
             self.parse_all_spectra()
 
             print('Writing metadata...')
-            self.write_metadata({'dataset_type': self.dataset_type})
+            self.write_metadata({'dataset_type': self.dataset_type, 'extractor': self.extractor})
+
+    def dataset_zip(self):
+        dataset_file = {
+            DatasetType.GENERATED:                  'generated.zip',
+            DatasetType.BILLBOARD_MAJMIN_TINY:      'billboard-tiny.zip',
+            DatasetType.BILLBOARD_MAJMIN7_TINY:     'billboard-tiny.zip',
+            DatasetType.BILLBOARD_MAJMIN_SMALL:     'billboard-small.zip',
+            DatasetType.BILLBOARD_MAJMIN7_SMALL:    'billboard-small.zip',
+            DatasetType.BILLBOARD_MAJMIN_ALL:       'billboard-all.zip',
+            DatasetType.BILLBOARD_MAJMIN7_ALL:      'billboard-all.zip'
+        }.get(self.dataset_type)
+
+        return dirs.root_path('misc', 'data_zips', dataset_file)
 
     def setup(self, stage=None):
         """Load the chord classification dataset.
@@ -132,103 +349,99 @@ class ChordDataModule(pl.LightningDataModule):
                 as also given in music_utils.
         """
 
-        signals, targets, metadatas = [], [], []
-
-        files = file_utils.files_with_extension(dirs.data_path(), 'pickle')
-        files = [f for f in files if (self.file_filter in f)]
-
-        for chord_file in files:
-            with open(dirs.data_path(chord_file), 'rb') as f:
-                data = pickle.load(f)
-
-            if data['annotation_mistiming'] > self.MISTIMING_THRESHOLD:
-                continue
-
-            signals.append(data['chromas'])
-            targets.append(data['chords'])
-
-            metadatas.append({'beats': data['beats'], 'annotations': data['annotations'],
-                              'song': file_utils.remove_extension(chord_file)})
-
-        # Convert signals / targets from 2d list to list of sequence tensors of shape T x *
-        signals = [np.stack(s) / np.max(np.stack(s)) for s in signals]
-        signals = [torch.from_numpy(s).type(torch.FloatTensor) for s in signals]
-        targets = [torch.tensor(t) for t in targets]
+        self.check_extractor()
+        if not store_utils.FeatureStore.exists(dirs.data_path('store')):
+            self.build_store()
+        store = store_utils.FeatureStore(dirs.data_path('store'))
+        if len(store) == 0:
+            raise RuntimeError('The feature store is empty, fetch the data again')
 
-        all_data = ListDataset(signals, targets, metadatas)
+        # Filtering and splitting only query the manifest, only selected songs are loaded
+        ids = store.select(self.file_filter, self.MISTIMING_THRESHOLD)
+        stats = store.stats(ids)
+        print(f'Selected {stats["song_n"]}/{len(store)} songs, {stats["beat_n"]} beats, '
+              f'{stats["duration"] / 3600:.1f} hours')
 
         assert len(self.split) == 3
-        train_size = int(self.split[0] * len(all_data))
-        val_size = int(self.split[1] * len(all_data))
-        test_size = len(all_data) - train_size - val_size
+        train_size = int(self.split[0] * len(ids))
+        val_size = int(self.split[1] * len(ids))
 
-        self.train_data, self.val_data, self.test_data = \
-            random_split(all_data, [train_size, val_size, test_size])
+        # Same assignment as random_split over the selected songs
+        permutation = torch.randperm(len(ids)).tolist()
+        split_ids = [[ids[i] for i in permutation[:train_size]],
+                     [ids[i] for i in permutation[train_size:train_size + val_size]],
+                     [ids[i] for i in permutation[train_size + val_size:]]]
+
+        self.train_data, self.val_data, self.test_data = [self.store_dataset(store, split)
+                                                          for split in split_ids]
 
         if self.augment:
-            self.train_data = self.augment_dataset(self.train_data, range(-6, 6))
+            self.train_data = self.augment_dataset(self.train_data, range(-6, 6),
+                                                   random_shift=self.random_shift)
         else:
             self.train_data = self.augment_dataset(self.train_data, [0])
         self.val_data = self.augment_dataset(self.val_data, [0])
         self.test_data = self.augment_dataset(self.test_data, [0])
+        # Validation and testing stay on whole songs
+        if self.chunk_len:
+            self.train_data = ChunkedDataset(self.train_data, self.chunk_len, self.chunk_margin)
 
         # self.report_data_stats()
 
         loader = self.train_dataloader()
 
-    def augment_dataset(self, dataset, shifts):
-        if len(dataset) == 0:
-            return dataset
-
-        datasets = []
-        bins_per_note = self.props.bin_n // 12
-
-        for shift in shifts:
-            new_signals, new_targets, new_metadatas = [], [], []
-
-            for (signal, target, metadata) in dataset:
-                # chromas are augmented in one octave both directions
-                # Get correct octave_n length chroma for the shift
-                def shift_chord(chord, shift):
-                    root, quality = chord[0].item(), chord[1].item()
-                    if self.props.encoding.qualities[0] == 'N' and quality == 0:
-                        return (root, quality)
-
-                    if root == music_utils.NO_ENCODING:
-                        return (root, quality)
+    def store_dataset(self, store, ids):
+        metadatas = [{'beats': metadata['beats'], 'annotations': metadata['annotations'],
+                      'song': metadata['song']} for metadata in store.metadatas(ids)]
+        # Signals / targets are lazy sequences of T x * tensor views into the store
+        return ListDataset(store.signals(ids), store.targets(ids), metadatas,
+                           lengths=store.lengths(ids))
 
-                    return ((root - shift) % 12, quality)
+    def build_store(self):
+        """Consolidates the parsed spectra pickles in the data directory into a feature store."""
+        chord_files = file_utils.files_with_extension(dirs.data_path(), 'pickle')
+        if len(chord_files) == 0:
+            # Fetches write the store directly, this is left behind when one was interrupted
+            raise RuntimeError('The feature store is incomplete, fetch the data again')
 
+        writer = store_utils.FeatureStoreWriter(dirs.data_path('store'), dtype=self.store_dtype,
+                                                encoding=type(self.props.encoding).__name__)
 
-                new_signals.append(signal[:, self.props.bin_n + shift * bins_per_note :
-                                            -self.props.bin_n + shift * bins_per_note])
-                new_targets.append(torch.tensor([shift_chord(chord, shift) for chord in target]))
-
-                metadata = copy.deepcopy(metadata)
-                metadata['song'] += f' ({shift:+})'
-                new_metadatas.append(metadata)
-
-            datas = list(zip(new_signals, new_targets, new_metadatas))
-            random.shuffle(datas)
-            new_signals, new_targets, new_metadatas = zip(*datas)
+        for chord_file in chord_files:
+            with open(dirs.data_path(chord_file), 'rb') as f:
+                data = pickle.load(f)
+            writer.add(file_utils.remove_extension(chord_file), data)
 
-            datasets.append(
-                ListDataset(list(new_signals), list(new_targets), list(new_metadatas)))
+        writer.close()
 
-        return torch.utils.data.ConcatDataset(datasets)
+    def augment_dataset(self, dataset, shifts, random_shift=False):
+        return TransposedDataset(dataset, shifts, self.props, random_shift=random_shift)
 
 
     def train_dataloader(self):
-        return DataLoader(self.train_data, batch_size=self.batch_size,
-                          num_workers=0, collate_fn=pad_collate)
+        # Lengths are passed down from the store offsets, no song is loaded or transposed
+        sampler = BucketBatchSampler(self.train_data.lengths(), self.batch_size,
+                                     self.bucket_boundaries, seed=self.seed)
+        return DataLoader(self.train_data, batch_sampler=sampler, collate_fn=pad_collate,
+                          **self.loader_args())
 
     def val_dataloader(self):
-        return DataLoader(self.val_data, batch_size=1, num_workers=0,
-                          collate_fn=pad_collate)
+        return DataLoader(self.val_data, batch_size=1, collate_fn=pad_collate,
+                          **self.loader_args())
 
     def test_dataloader(self):
-        return DataLoader(self.test_data, batch_size=1, num_workers=0,
-                          collate_fn=pad_collate)
+        return DataLoader(self.test_data, batch_size=1, collate_fn=pad_collate,
+                          **self.loader_args())
+
+    def loader_args(self):
+        """Worker and memory arguments shared by all DataLoaders."""
+        args = {'num_workers': self.loader_workers, 'pin_memory': self.pin_memory}
+        if self.loader_workers > 0:
+            # Only valid with worker processes
+            args['persistent_workers'] = self.persistent_workers
+            args['prefetch_factor'] = self.prefetch_factor
+            args['multiprocessing_context'] = self.loader_context
+        return args
 
 
     def report_data_stats(self):
@@ -276,6 +489,18 @@ class ChordDataModule(pl.LightningDataModule):
         with open(dirs.data_path('metadata'), 'wb') as file:
             return pickle.dump(metadata, file)
 
+    def stored_extractor(self, metadata):
+        """Extractor of the stored features, datasets fetched before cqt existed used dct."""
+        return metadata.get('extractor', 'dct')
+
+    def check_extractor(self):
+        """Raises if the stored features were parsed with another extractor than requested."""
+        metadata = self.read_metadata()
+        if metadata is not None and self.stored_extractor(metadata) != self.extractor:
+            raise RuntimeError(f'Requested the {self.extractor} extractor but the stored features '
+                               f'were parsed with {self.stored_extractor(metadata)}, fetch the '
+                               f'data again to re-extract them')
+
     def read_metadata(self):
         try:
             with open(dirs.data_path('metadata'), 'rb') as file:
@@ -287,39 +512,100 @@ class ChordDataModule(pl.LightningDataModule):
 
 
     def parse_all_spectra(self):
-        """Parses all wav files in the data directory and outputs the spectra pickle files."""
-        wavs = file_utils.files_with_extension(dirs.data_path(), 'wav')
-        for wav_file in wavs:
-            parsers = {
-                DatasetType.GENERATED:                  self.parse_spectra_generated,
-                DatasetType.BILLBOARD_MAJMIN_TINY:      self.parse_spectra_song,
-                DatasetType.BILLBOARD_MAJMIN7_TINY:     self.parse_spectra_song,
-                DatasetType.BILLBOARD_MAJMIN_SMALL:     self.parse_spectra_song,
-                DatasetType.BILLBOARD_MAJMIN7_SMALL:    self.parse_spectra_song,
-                DatasetType.BILLBOARD_MAJMIN_ALL:       self.parse_spectra_song,
-                DatasetType.BILLBOARD_MAJMIN7_ALL:      self.parse_spectra_song
-            }
-
-            try:
-                parsed = parsers[self.dataset_type](dirs.data_path(wav_file))
-            except KeyboardInterrupt:
-                sys.exit()
-            except Exception as e:
-                print(e)
-                print(f'Got exception on parsing {wav_file} -- skipping')
-                continue
+        """Parses all wav files in the dataset zip and writes the spectra to the feature store.
+
+        Wav members are read straight from the zip into memory, nothing is extracted. With more
+        than one worker, songs are farmed out to a process pool which also reads the members in
+        parallel. Results are stored in zip order; a failing song is reported and skipped
+        without aborting the run.
+        """
+        with zipfile.ZipFile(self.dataset_zip(), 'r') as zip_ref:
+            wavs = [member for member in zip_ref.namelist() if member.endswith('.wav')]
+
+        if self.workers > 1:
+            pool = multiprocessing.Pool(self.workers)
+            results = pool.imap(self.parse_spectra_member, wavs)
+        else:
+            pool = None
+            results = map(self.parse_spectra_member, wavs)
+
+        writer = store_utils.FeatureStoreWriter(dirs.data_path('store'), dtype=self.store_dtype,
+                                                encoding=type(self.props.encoding).__name__)
+
+        failures = []
+        start_time = time.time()
+        try:
+            for i, (wav_file, (parsed, error)) in enumerate(zip(wavs, results)):
+                if error is not None:
+                    print(f'Got exception on parsing {wav_file} -- skipping\n{error}')
+                    failures.append(wav_file)
+                else:
+                    song = file_utils.remove_extension(file_utils.file_name(wav_file))
+                    writer.add(song, parsed)
+
+                rate = (i + 1) / (time.time() - start_time)
+                print(f'[{i + 1}/{len(wavs)}] {wav_file} ({rate:.2f} songs/s)')
+        except KeyboardInterrupt:
+            if pool is not None:
+                pool.terminate()
+            sys.exit()
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        writer.close()
 
-            parsed_name = file_utils.change_extension(wav_file, 'pickle')
-            with open(dirs.data_path(parsed_name), 'wb') as out:
-                pickle.dump(parsed, out)
+        print(f'Parsed {len(wavs) - len(failures)}/{len(wavs)} songs '
+              f'in {time.time() - start_time:.1f}s, {len(failures)} failed')
 
-    def parse_spectra_generated(self, wav_file):
-        f0, data = wav.read(wav_file)
+    def parse_spectra_member(self, wav_file):
+        """Parses a single wav member of the dataset zip.
+
+        Returns:
+            Tuple (parsed data, None) on success, otherwise (None, description of the exception).
+        """
+        parsers = {
+            DatasetType.GENERATED:                  self.parse_spectra_generated,
+            DatasetType.BILLBOARD_MAJMIN_TINY:      self.parse_spectra_song,
+            DatasetType.BILLBOARD_MAJMIN7_TINY:     self.parse_spectra_song,
+            DatasetType.BILLBOARD_MAJMIN_SMALL:     self.parse_spectra_song,
+            DatasetType.BILLBOARD_MAJMIN7_SMALL:    self.parse_spectra_song,
+            DatasetType.BILLBOARD_MAJMIN_ALL:       self.parse_spectra_song,
+            DatasetType.BILLBOARD_MAJMIN7_ALL:      self.parse_spectra_song
+        }
+
+        try:
+            return parsers[self.dataset_type](wav_file, archive=self.dataset_zip()), None
+        except Exception as e:
+            return None, f'{type(e).__name__}: {e}'
+
+    def read_audio(self, wav_file, archive=None):
+        """Decodes a wav file, or a wav member of the zip archive if given, exactly once.
+
+        Returns:
+            Tuple (audio_utils.Audio, content hash of the wav).
+        """
+        name = file_utils.file_name(wav_file)
+
+        if archive is not None:
+            with zipfile.ZipFile(archive, 'r') as zip_ref:
+                wav_bytes = zip_ref.read(wav_file)
+            return Audio.read(wav_bytes, name=name), cache_utils.hash_bytes(wav_bytes)
+
+        return Audio.read(wav_file, name=name, mmap=True), cache_utils.hash_file(wav_file)
+
+    def parse_spectra_generated(self, wav_file, archive=None):
+        audio, _ = self.read_audio(wav_file, archive)
+        f0, data = audio.sample_rate, audio.samples
         wav_file = file_utils.file_name(wav_file)
 
         octaves = list(range(self.START_OCTAVE - 1,
                              self.START_OCTAVE + self.props.octave_n + 1))
-        chroma = self.parse_spectra_window(data, f0, octaves, t_start=0.0, win=0.5)
+        if self.extractor == 'cqt':
+            chroma = self.parse_spectra_pooled(data, f0, octaves, [0.0, 0.5])[0]
+        else:
+            chroma = self.parse_spectra_window(data, f0, octaves, t_start=0.0, win=0.5)
         chroma = chroma.flatten()
 
         chord_name = file_utils.remove_extension(wav_file)
@@ -328,60 +614,81 @@ class ChordDataModule(pl.LightningDataModule):
 
         return { 'chromas': [chroma], 'chords': [chord.to_tuple()],
                  'beats': [], 'annotations': [(chord.to_tuple(), 0.0, 3.0)],
-                 'annotation_mistiming': 0.0}
+                 'annotation_mistiming': 0.0, 'duration': audio.duration()}
 
-    def parse_spectra_song(self, wav_file, beat_info=None, read_annotations=True):
+    def parse_spectra_song(self, wav_file, beat_info=None, read_annotations=True, archive=None):
         """Parse beat and spectral information from a wav_file.
 
+        Beats, chromas and annotations are looked up in the feature cache by content hash and
+        only computed when missing, so switching encodings only redoes the annotation matching.
+
         Arguments:
             wav_file: the file path.
             beat_info: tuple (bpm, beats) if tempo has already been detected.
             read_annotations: whether to match annotation data against the beats.
+            archive: dataset zip to read the wav member and its annotations from, instead of
+                the file system / data directory.
 
         Returns:
             Dict of parsed data.
         """
-        f0, data = wav.read(wav_file)
-        last_time = data.shape[0] / f0;
+        audio, audio_hash = self.read_audio(wav_file, archive)
+        f0, data = audio.sample_rate, audio.samples
+        last_time = audio.duration()
 
-        detector = TempoDetector()
-        detector.uploadSong(wav_file)
-        bpm, beats_orig = detector.detectBPM('RNN')
+        if beat_info is None:
+            beat_info = self.detect_beats(audio, audio_hash)
+
+        bpm, beats_orig = beat_info
         # TODO: sometimes tempo detector spits out beat past end of song...
-        beats_orig = [beat for beat in beats_orig.tolist() if beat < last_time]
+        beats_orig = [beat for beat in np.asarray(beats_orig).tolist() if beat < last_time]
         beats = [0.0] + beats_orig + [last_time]
 
         wav_file = file_utils.file_name(wav_file)
 
         if read_annotations:
-            annotations = annotation_utils.load_annotations(
-                wav_file[:4], self.dataset_type, self.props.encoding)
+            annotations_text = annotation_utils.read_annotations_file(
+                wav_file[:4], self.dataset_type, archive)
+            annotations_key = cache_utils.hash_bytes(annotations_text.encode()) + \
+                cache_utils.hash_params(self.props.encoding.roots, self.props.encoding.qualities)
+
+            annotations = self.cache.get('annotations', annotations_key)
+            if annotations is None:
+                annotations = annotation_utils.parse_annotations(
+                    annotations_text, self.props.encoding)
+                self.cache.put('annotations', annotations_key, annotations)
+
+        # Add one extra low and high octave for data augmentation later
+        octaves = list(range(self.START_OCTAVE - 1,
+                             self.START_OCTAVE + self.props.octave_n + 1))
 
-        chromas, chords = [], []
-        for (current_beat, next_beat) in zip(beats[:-1], beats[1:]):
-            beat_len = next_beat - current_beat
-            # Add one extra low and high octave for data augmentation later
-            octaves = list(range(self.START_OCTAVE - 1,
-                                 self.START_OCTAVE + self.props.octave_n + 1))
-            chroma = self.parse_spectra_repeated(
-                data, f0, octaves, t_start=current_beat, win=beat_len)
-            chromas.append(chroma.flatten())
+        chromas_key = audio_hash + cache_utils.hash_params(
+            beats, self.extractor, octaves, self.props.bin_n, self.SUBWINDOW_N, self.seed,
+            self.CQT_HOP, self.FEATURES_VERSION)
 
-            if read_annotations:
-                chords.append(annotation_utils.best_match(annotations, current_beat, next_beat))
+        chromas = self.cache.get('chromas', chromas_key)
+        if chromas is None:
+            # Seed the subwindow draws per song so cached chromas are reproducible
+            rng = random.Random(f'{self.seed}-{audio_hash}')
+            spectra = self.parse_spectra_beats(data, f0, octaves, beats, rng=rng)
+            chromas = [chroma.flatten() for chroma in spectra]
+            self.cache.put('chromas', chromas_key, chromas)
 
+        chords = []
         if read_annotations:
-            def get_closest_beat(t):
-                return min([abs(b - t) for b in beats])
-            beat_dists = [get_closest_beat(annotation[1]) for annotation in annotations]
-            annotation_mistiming = sum(beat_dists) / len(beat_dists)
+            chords = annotation_utils.best_matches(annotations, beats)
+
+        if read_annotations:
+            beat_dists = annotation_utils.nearest_distances(
+                [annotation[1] for annotation in annotations], beats)
+            annotation_mistiming = float(np.mean(beat_dists))
             annotation_mistiming *= 60 / bpm # Convert to fraction of beat length
 
             print(f'Parsed: {wav_file}, annotation mistiming {annotation_mistiming:.2f}')
         else:
             print(f'Parsed: {wav_file}')
 
-        data = { 'chromas': chromas, 'beats': beats_orig }
+        data = { 'chromas': chromas, 'beats': beats_orig, 'duration': last_time }
         if read_annotations:
             data['chords'] = chords
             data['annotations'] = annotations
@@ -390,6 +697,71 @@ class ChordDataModule(pl.LightningDataModule):
         return data
 
 
+    def detect_beats(self, audio, audio_hash):
+        """Detects the tempo and beats of a song, reusing earlier detections from the beat cache.
+
+        Parameters:
+            audio: the decoded audio_utils.Audio.
+            audio_hash: content hash of the audio file.
+
+        Returns:
+            Tuple (bpm, beats) with the beat times in seconds.
+        """
+        beats_key = audio_hash + cache_utils.hash_params(TempoDetector.RNN_CONFIG)
+        beat_info = self.cache.get('beats', beats_key)
+        if beat_info is None:
+            detector = TempoDetector()
+            detector.uploadSong(audio)
+            bpm, beats = detector.detectBPM('RNN')
+            beat_info = (float(bpm), np.asarray(beats, dtype=np.float64))
+            self.cache.put('beats', beats_key, beat_info)
+        return beat_info
+
+    def parse_spectra_beats(self, data, f0, octaves, beats, rng=random):
+        """Parses the spectra between every pair of consecutive beats with the selected extractor.
+
+        Parameters:
+            data: numpy array of audio data
+            f0: sampling frequency
+            octaves: list of octaves to parse relative to A440, e.g. [-3, -2, -1, 0, 1, 2]
+            beats: list of beat times, including the start and end of the audio
+            rng: random number generator for the subwindow draws
+
+        Returns:
+            Array of size [len(beats) - 1 x n_oct x bin_n].
+        """
+        if self.extractor == 'cqt':
+            return self.parse_spectra_pooled(data, f0, octaves, beats)
+
+        # Transform all beats of the song in one batch
+        windows = []
+        for (current_beat, next_beat) in zip(beats[:-1], beats[1:]):
+            beat_len = next_beat - current_beat
+            windows.append((current_beat, beat_len))
+            windows += self.random_subwindows(current_beat, beat_len, rng=rng)
+
+        spectra = self.parse_spectra_windows(data, f0, octaves, windows)
+        spectra = spectra.reshape(len(beats) - 1, self.SUBWINDOW_N + 1, len(octaves), -1)
+        return spectra.mean(1)
+
+    def parse_spectra_pooled(self, data, f0, octaves, beats):
+        """Computes one constant-Q spectrogram for the audio and averages it within every beat.
+
+        Parameters match parse_spectra_beats.
+        """
+
+        # If stereo, make mono
+        if len(data.shape) == 2:
+            dataM = data[:,0] + data[:,1]
+        else:
+            dataM = data
+
+        power, frame_times = spectra_utils.cqt_spectrogram(
+            dataM, f0, tuple(octaves), self.props.bin_n, hop=self.CQT_HOP)
+        spectra = spectra_utils.pool_frames(power, frame_times, beats)
+
+        return np.log(1 + spectra.reshape(len(beats) - 1, len(octaves), self.props.bin_n))
+
     def parse_spectra_repeated(self, data, f0, octaves, t_start=0.0, win=3.0):
         """Samples the window with many random subwindows to ensure that all notes are covered.
 
@@ -406,21 +778,69 @@ class ChordDataModule(pl.LightningDataModule):
             Matrix of size [n_oct x 12], splitting the spectrum into multiple octaves.
         """
 
-        subwindow_n = 10
+        windows = [(t_start, win)] + self.random_subwindows(t_start, win)
+        return self.parse_spectra_windows(data, f0, octaves, windows).mean(0).squeeze()
 
-        spectra = self.parse_spectra_window(data, f0, octaves, t_start, win)
-        for i in range(subwindow_n):
-            rand_1, rand_2 = random.uniform(0, win), random.uniform(0, win)
+    def random_subwindows(self, t_start, win, rng=random):
+        """Draws SUBWINDOW_N random subwindows (t_start, win) of the window using rng."""
+        subwindows = []
+        for i in range(self.SUBWINDOW_N):
+            rand_1, rand_2 = rng.uniform(0, win), rng.uniform(0, win)
             fact = 5 # Higher drives the edges of the subwindow closer to teh window
             rand_start = min(rand_1, rand_2) / fact
             rand_win = max(rand_1, rand_2) - rand_start + \
                        (win - max(rand_1, rand_2)) * (fact - 1) / fact
             assert rand_win < win and rand_win > win / 2
-            spectra += self.parse_spectra_window(data, f0, octaves, t_start+rand_start, rand_win)
+            subwindows.append((t_start + rand_start, rand_win))
+
+        return subwindows
+
+    def parse_spectra_windows(self, data, f0, octaves, windows):
+        """Batched version of parse_spectra_window over many windows of the same audio.
+
+        Windows are cut to spectra_utils.window_length samples. Windows with the same sample
+        count are transformed together in a single DCT call and share a bin matrix.
+
+        Parameters:
+            data: numpy array of audio data
+            f0: sampling frequency
+            octaves: list of octaves to parse relative to A440, e.g. [-3, -2, -1, 0, 1, 2]
+            windows: list of (t_start, win) tuples
 
-        spectra /= (subwindow_n + 1)
+        Returns:
+            Array of size [len(windows) x n_oct x bin_n].
+        """
+
+        # If stereo, make mono
+        if len(data.shape) == 2:
+            dataM = data[:,0] + data[:,1]
+        else:
+            dataM = data
 
-        return spectra
+        spectra = np.zeros((len(windows), len(octaves) * self.props.bin_n))
+
+        groups = {}
+        for i, (t_start, win) in enumerate(windows):
+            win_samps = spectra_utils.window_length(int(win*f0))
+            groups.setdefault(win_samps, []).append((i, int(f0 * t_start)))
+
+        for win_samps, group in groups.items():
+            # Windows running past the end of the audio are left as zero power
+            group = [(i, start_i) for (i, start_i) in group if start_i + win_samps <= len(dataM)]
+            if len(group) == 0:
+                continue
+
+            indices = [i for (i, _) in group]
+            segments = np.stack([dataM[start_i:start_i + win_samps] for (_, start_i) in group])
+            segments = segments.astype(np.float64)
+
+            # Power
+            PofT = dct(segments, norm='ortho', axis=1, workers=-1)**2
+
+            binning = spectra_utils.bin_matrix(win_samps, f0, tuple(octaves), self.props.bin_n)
+            spectra[indices] = (binning @ PofT.T).T
+
+        return np.log(1 + spectra.reshape(len(windows), len(octaves), self.props.bin_n))
 
 
     def parse_spectra_window(self, data, f0, octaves, t_start=0.0, win=3.0):
@@ -451,7 +871,8 @@ class ChordDataModule(pl.LightningDataModule):
         subwin = win
 
         win_samps = int(win*f0)
-        subwin_samps = int(subwin*f0)
+        # Same window lengths as parse_spectra_windows
+        subwin_samps = spectra_utils.window_length(int(subwin*f0))
 
         # Choose how many windows
         Nwins = 1
@@ -477,46 +898,8 @@ class ChordDataModule(pl.LightningDataModule):
         # Power
         PofT = FofT**2 #Had log before
 
-        ts = np.arange(0,win*(Nwins + 1),win)
-
-        # Now iterate through octaves to bin frequencies by note and visualize spectrograms more easily
-        A = 440 #Hz, A above middle C
-        note_names = ['A','Bb','B','C','C#','D','Eb','E','F','F#','G','Ab','A']
-
-        # Z:= num substones. Subtones := number of divisions of a semitone (made this up). Z = 1 for normal binning
-        assert self.props.bin_n % 12 == 0
-        Z = self.props.bin_n // 12
-
-        # Store discretized notes per octave
-        subtonesofToct = np.zeros((len(octaves),(len(note_names)-1)*Z,Nwins))
-
-        for i, octv in enumerate(octaves):
-            # Frequencies in Hz for half step pitches
-            notes = A*2**octv*np.power(2**(1/12), np.arange(0,12+1,1))
-            # Frequencies in Hz for subtones, which define the bin boundaries
-            subtones = A*2**octv*np.power(2**(1/12), np.arange(1/(2*Z), 12 + 1/(2*Z), 1/Z))
-            # Convert frequencies into DCT coefficient indices
-            note_is = notes*(2*subwin_samps/f0)
-            note_is = note_is.astype(int)
-            subtone_is = subtones*(2*subwin_samps/f0)
-            subtone_is = subtone_is.astype(int)
-
-            low_i = note_is[0]
-            high_i = note_is[-1]
-            fs_oct = fs[low_i:high_i]
-            PofT_oct = PofT[low_i:high_i,:]
-
-            # Bin by note, take averages
-            for j in range(12 * Z):
-                if j == 0:
-                    # Get the notes in the ranges between A and A 1/(2Z) sharp, and G 1/(2Z) sharp and A
-                    notepow = np.vstack((PofT[low_i:subtone_is[0],:], PofT[subtone_is[-1]:high_i, :]))
-                else:
-                    notepow = PofT[subtone_is[j-1]:subtone_is[j]]
-
-                len_notepow, _ = np.shape(notepow)
-
-                if len_notepow != 0:
-                    subtonesofToct[i, j, :] += np.sum(notepow, axis = 0)/len_notepow
+        # Bin frequencies by note, averaging the power that falls into each subtone
+        binning = spectra_utils.bin_matrix(subwin_samps, f0, tuple(octaves), self.props.bin_n)
+        subtonesofToct = (binning @ PofT).reshape(len(octaves), self.props.bin_n, Nwins)
 
         return np.log(1 + subtonesofToct.squeeze())
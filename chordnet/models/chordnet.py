@@ -24,6 +24,9 @@ class ChordNet(Model):
         # How far to look backwards / forwards for prediction. [0] is just the current chord
         self.history_inclusions = list(range(-5, 6))
         # self.history_inclusions = [0]
+        # Must be a contiguous range, frames are gathered as sliding windows
+        assert self.history_inclusions == list(range(self.history_inclusions[0],
+                                                     self.history_inclusions[-1] + 1))
         in_channels = len(self.history_inclusions)
 
         self.shared_net = build_spectrum_sequential(
@@ -44,19 +47,69 @@ class ChordNet(Model):
             nn.Linear(quality_hidden, data_props.encoding.quality_n())
         )
 
-        self.loss_func = nn.NLLLoss()
+        # root_rotations[root, i] is the note rolled to index i when rolling by minus root
+        rotations = (torch.arange(12).unsqueeze(0) + torch.arange(12).unsqueeze(1)) % 12
+        self.register_buffer('root_rotations', rotations, persistent=False)
 
-    def forward(self, x):
-        seq_n = x.shape[0]
+        self.loss_func = nn.NLLLoss(reduction='none')
+
+    def forward(self, x, lengths=None):
+        batched = x.dim() == 3
+        if not batched:
+            x = x.unsqueeze(0)
+        batch_n, seq_n = x.shape[0], x.shape[1]
+
+        if lengths is not None:
+            # Padding frames must look like the zeros outside of each sequence
+            is_frame = torch.arange(seq_n, device=x.device).unsqueeze(0) < lengths.unsqueeze(1)
+            x = x * is_frame.unsqueeze(2)
+
+        windows = self.history_windows(x)
+        roots, qualities = self.classify(windows.reshape(batch_n * seq_n, *windows.shape[2:]))
+        roots, qualities = roots.reshape(batch_n, seq_n, -1), qualities.reshape(batch_n, seq_n, -1)
+
+        if not batched:
+            roots, qualities = roots[0], qualities[0]
+
+        reg = torch.tensor(0.0, device=self.device)
+
+        return roots, qualities, reg
+
+    def history_windows(self, x):
+        """Applies the shared net and gathers the past / future frames around each frame.
+
+        Args:
+            x: (B x) T x (octave_n * bin_n) Tensor.
 
-        # Take x and add channels corresponding to past / future chords
-        rolls = [self.roll_zeros_seq(x, roll_amount) for roll_amount in self.history_inclusions]
-        x = torch.flip(torch.stack(rolls, 1), (1, ))
+        Returns:
+            (B x) T x len(history_inclusions) x F Tensor, the shared_net outputs of the frames
+            around each frame, oldest first. Frames outside the sequence are zeros.
+        """
+        past_n, future_n = -self.history_inclusions[0], self.history_inclusions[-1]
+        frame_shape = x.shape[:-1]
 
-        # Flatten past/future seq to apply the shared net
-        x = x.reshape(-1, 1, x.shape[2])
-        x = self.shared_net(x)
-        x = x.reshape(seq_n, -1, x.shape[2])
+        # Apply the shared net once per frame, and once to the zero frame padding the sequence
+        x = torch.cat((x.reshape(-1, x.shape[-1]), x.new_zeros(1, x.shape[-1])))
+        x = self.shared_net(x.unsqueeze(1)).squeeze(1)
+        frames, padding = x[:-1].reshape(*frame_shape, -1), x[-1]
+
+        # Sliding windows over the padded frames, as channels
+        frames = torch.cat((padding.expand(*frame_shape[:-1], past_n, -1), frames,
+                            padding.expand(*frame_shape[:-1], future_n, -1)), dim=-2)
+        return frames.unfold(-2, len(self.history_inclusions), 1).transpose(-2, -1)
+
+    def classify(self, x):
+        """Classifies windows of shared_net outputs.
+
+        Args:
+            x: T x len(history_inclusions) x F Tensor, the shared_net outputs of the past to
+            future frames around each frame, oldest first.
+
+        Returns:
+            roots: T x root_n Tensor.
+            qualities: T x quality_n Tensor.
+        """
+        seq_n = x.shape[0]
 
         # Flatten bins to 12 per octave
         x = self.attention_net(x)
@@ -72,19 +125,86 @@ class ChordNet(Model):
         # Creates quality invariance to root shifts
 
         # Roll all elements of each history by the root of the middle chord
-        x = self.roll_dim(x, tuple((-roots_selected).tolist()), dim=0).reshape(seq_n, -1)
-
-        qualities = F.log_softmax(self.quality_net(x))
-
-        reg = torch.tensor(0.0, device=self.device)
-
-        return roots, qualities, reg
-
-    def roll_dim(self, tensor, roll_amounts, dim):
-        rolled = []
-        for t, roll_amount in zip(torch.unbind(tensor, dim), roll_amounts):
-            rolled.append(torch.roll(t, roll_amount, -1))
-        return torch.stack(rolled, dim)
+        x = self.roll_dim(x, roots_selected).reshape(seq_n, -1)
+
+        qualities = F.log_softmax(self.quality_net(x), dim=1)
+
+        return roots, qualities
+
+    def start_stream(self):
+        """Resets the incremental inference state, see step."""
+        window_n = len(self.history_inclusions)
+        spectra_len = self.data_props.octave_n * self.data_props.bin_n
+
+        # Frames outside the sequence are zeros in forward, so fill the window with their output
+        with torch.no_grad():
+            zeros = torch.zeros(1, 1, spectra_len, device=self.device)
+            self.stream_padding = self.shared_net(zeros).reshape(-1)
+        self.stream_window = self.stream_padding.repeat(window_n, 1)
+        self.stream_head = 0 # Ring buffer index of the oldest frame
+        self.stream_frame_n = 0 # Frames pushed, including padding pushed by flush
+        self.stream_real_n = 0 # Frames pushed by step
+        self.stream_emitted_n = 0
+
+    def step(self, x):
+        """Incremental inference: pushes the spectrum of the next frame (beat) of a stream.
+
+        Only the shared_net output of the new frame is computed; the outputs of the frames in the
+        window are kept in a ring buffer, so every frame costs the same regardless of how long
+        the stream is. Call start_stream before the first frame of every stream.
+
+        Args:
+            x: (octave_n * bin_n) Tensor, the spectrum of the next frame.
+
+        Returns:
+            Tuple (roots, qualities) of 1 x root_n and 1 x quality_n Tensors for the frame which
+            now has all its future context, i.e. history_inclusions[-1] frames before x. Matches
+            forward on the whole sequence. None while there is no such frame yet.
+        """
+        with torch.no_grad():
+            frame = self.shared_net(x.reshape(1, 1, -1)).reshape(-1)
+        self.stream_real_n += 1
+        return self.push_stream_frame(frame)
+
+    def flush(self):
+        """Finishes a stream.
+
+        Returns:
+            List of the (roots, qualities) of the frames step has not returned yet, in order.
+        """
+        outputs = []
+        while self.stream_emitted_n < self.stream_real_n:
+            output = self.push_stream_frame(self.stream_padding)
+            if output is not None:
+                outputs.append(output)
+        return outputs
+
+    def push_stream_frame(self, frame):
+        window_n = len(self.history_inclusions)
+        self.stream_window[self.stream_head] = frame
+        self.stream_head = (self.stream_head + 1) % window_n
+        self.stream_frame_n += 1
+
+        # The returned frame sits history_inclusions[-1] frames before the newest one
+        if self.stream_frame_n <= self.history_inclusions[-1]:
+            return None
+
+        order = (self.stream_head + torch.arange(window_n, device=self.device)) % window_n
+        with torch.no_grad():
+            roots, qualities = self.classify(self.stream_window[order].unsqueeze(0))
+        self.stream_emitted_n += 1
+        return roots, qualities
+
+    def roll_dim(self, tensor, roots):
+        """Rolls the notes of every frame by minus its root, so the root lands at index 0.
+
+        Args:
+            tensor: ... x 12 Tensor, where the leading dims start with the dims of roots.
+            roots: Long Tensor of the root of every frame, e.g. of shape T or B x T.
+        """
+        index = self.root_rotations[roots]
+        index = index.reshape(*roots.shape, *[1] * (tensor.dim() - roots.dim() - 1), 12)
+        return torch.gather(tensor, -1, index.expand_as(tensor))
 
     def roll_zeros_seq(self, tensor, roll_amount):
         # Roll along the zeroeth dim and fill in zeros
@@ -108,8 +228,8 @@ class ChordNet(Model):
         # return optimizer, scheduler
         return [optimizer], [scheduler]
 
-    def training_epoch_end(self, outputs):
-        super().training_epoch_end(outputs)
+    def on_train_epoch_end(self):
+        super().on_train_epoch_end()
 
         plt.switch_backend('agg')
 
@@ -117,7 +237,7 @@ class ChordNet(Model):
             fig = plt.figure()
             plt.plot(self.root_net[0].conv.weight.squeeze().cpu().detach().numpy())
             plt.ylim([-2, 2])
-            plt.xticks(ticks=range(12), labels=music_utils.roots)
+            plt.xticks(ticks=range(12), labels=self.data_props.encoding.roots)
             plt.grid()
 
             self.logger.experiment.add_figure('Root filter', fig, self.current_epoch)
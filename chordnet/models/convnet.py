@@ -26,9 +26,12 @@ class ConvNet(Model):
 
         self.quality_linear = nn.Linear(quality_n * octave_n * bin_n, quality_n)
 
-        self.loss_func = nn.NLLLoss()
+        self.loss_func = nn.NLLLoss(reduction='none')
 
-    def forward(self, x):
+    def forward(self, x, lengths=None):
+        # Frames are independent, so flatten any batch dimension into the frames
+        frame_shape = x.shape[:-1]
+        x = x.reshape(-1, x.shape[-1])
         batch_n = x.shape[0]
 
         x = x.unsqueeze(1)  # Add single channel to input
@@ -42,10 +45,11 @@ class ConvNet(Model):
         # Sum across octaves
         roots = roots.reshape(batch_n, self.data_props.octave_n, 12).sum(1)
 
-        roots = F.log_softmax(roots)
-        qualities = F.log_softmax(self.quality_linear(qualities))
+        roots = F.log_softmax(roots, dim=1)
+        qualities = F.log_softmax(self.quality_linear(qualities), dim=1)
 
-        return roots, qualities, torch.tensor(0.0)
+        return roots.reshape(*frame_shape, -1), qualities.reshape(*frame_shape, -1), \
+            torch.tensor(0.0)
 
     def configure_optimizers(self):
         optimizer = torch.optim.Adam(self.parameters(), lr=1e-3)
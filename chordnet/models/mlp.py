@@ -10,14 +10,14 @@ import pdb
 
 def build_sequential(in_length, out_length, L, H):
     if L <= 1:
-        return nn.Sequential(nn.Linear(in_length, out_length), nn.LogSoftmax(dim=1))
+        return nn.Sequential(nn.Linear(in_length, out_length), nn.LogSoftmax(dim=-1))
 
     modules = [nn.Linear(in_length, H), nn.ReLU()]
     for _ in range(L - 2):
         modules.append(nn.Linear(H, H))
         modules.append(nn.ReLU())
     modules.append(nn.Linear(H, out_length))
-    modules.append(nn.LogSoftmax(dim = 1))
+    modules.append(nn.LogSoftmax(dim=-1))
 
     return nn.Sequential(*modules)
 
@@ -33,9 +33,10 @@ class MLP(Model):
         self.root_net = build_sequential(spectra_len, root_n, L, H)
         self.quality_net = build_sequential(spectra_len, quality_n, L, H)
 
-        self.loss_func = nn.NLLLoss()
+        self.loss_func = nn.NLLLoss(reduction='none')
 
-    def forward(self, x):
+    def forward(self, x, lengths=None):
+        # Frames are independent, so padding needs no special care
         return self.root_net(x), self.quality_net(x), torch.tensor(0.0)
 
     def configure_optimizers(self):
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 import pytorch_lightning as pl
 
@@ -10,14 +11,14 @@ import pdb
 
 def build_sequential(in_length, out_length, L, H):
     if L <= 1:
-        return nn.Sequential(nn.Linear(in_length, out_length), nn.LogSoftmax(dim=1))
+        return nn.Sequential(nn.Linear(in_length, out_length), nn.LogSoftmax(dim=-1))
 
     modules = [nn.Linear(in_length, H), nn.ReLU()]
     for _ in range(L - 2):
         modules.append(nn.Linear(H, H))
         modules.append(nn.ReLU())
     modules.append(nn.Linear(H, out_length))
-    modules.append(nn.LogSoftmax(dim = 1))
+    modules.append(nn.LogSoftmax(dim=-1))
 
     return nn.Sequential(*modules)
 
@@ -41,14 +42,25 @@ class MLPRNN(Model):
         self.root_net = build_sequential(in_length, root_n, L, H)
         self.quality_net = build_sequential(in_length, quality_n, L, H)
 
-        self.loss_func = nn.NLLLoss()
+        self.loss_func = nn.NLLLoss(reduction='none')
 
         self.gradient_clip_val = 0.25
 
 
-    def forward(self, x):
-        hidden, _ = self.lstm(x.unsqueeze(0))
-        x = hidden[0]
+    def forward(self, x, lengths=None):
+        batched = x.dim() == 3
+        if not batched:
+            x = x.unsqueeze(0)
+        if lengths is None:
+            lengths = torch.full((x.shape[0], ), x.shape[1], dtype=torch.long)
+
+        # Pack so the backward direction starts at the end of each sequence, not in its padding
+        packed = pack_padded_sequence(x, lengths.cpu(), batch_first=True, enforce_sorted=False)
+        hidden, _ = self.lstm(packed)
+        x, _ = pad_packed_sequence(hidden, batch_first=True, total_length=x.shape[1])
+
+        if not batched:
+            x = x[0]
         return self.root_net(x), self.quality_net(x), torch.tensor(0.0)
 
     def configure_optimizers(self):
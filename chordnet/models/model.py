@@ -3,8 +3,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 import itertools
+import functools
 import numpy as np
-from sklearn.metrics import confusion_matrix
 
 import pytorch_lightning as pl
 
@@ -14,8 +14,8 @@ from matplotlib.patches import Rectangle
 from matplotlib import cm
 import tabulate
 
-from chordnet.utils.music_utils import Chord
-from chordnet.utils import list_utils, music_utils
+from chordnet.utils import music_utils
+from chordnet.utils.metrics_utils import MetricsAccumulator
 
 import pdb
 
@@ -25,24 +25,33 @@ class Model(pl.LightningModule):
 
     forward
     Args:
-        signal: T x (octave_n * bin_n) Tensor. T is the number of subdivisions in the audio
+        signal: (B x) T x (octave_n * bin_n) Tensor. T is the number of subdivisions in the audio
         sequence (generally number of beats). For each time subdivision, we get a copy of the
-        spectra.
+        spectra. B is the optional batch dimension.
+        lengths: optional B Tensor of sequence lengths for batches. Frames past the length of
+        their sequence are padding and must not affect the other frames.
 
     Returns:
-        roots: T x root_n Tensor.
-        qualities: T x quality_n Tensor.
+        roots: (B x) T x root_n Tensor.
+        qualities: (B x) T x quality_n Tensor.
         regularizer: scalar Tensor.
 
     loss_func
-    Matches signature of something like torch.nn.NLLLoss()
+    Matches signature of torch.nn.NLLLoss(reduction='none'), giving the loss of every frame
     """
 
+    STAGES = {'loss': 'Train', 'val_loss': 'Valid', 'test_loss': 'Test'} # By loss name
+
     def __init__(self, data_props):
         super().__init__()
         self.data_props = data_props
         self.save_hyperparameters()
 
+        # Epoch metrics are accumulated every step instead of from retained step outputs
+        self.epoch_metrics = {stage: MetricsAccumulator(data_props.encoding.root_n(),
+                                                        data_props.encoding.quality_n())
+                              for stage in self.STAGES.values()}
+
     def training_step(self, batch, batch_idx):
         return self.compute_losses(batch, 'loss')
 
@@ -53,134 +62,144 @@ class Model(pl.LightningModule):
         return self.compute_losses(batch, 'test_loss')
 
     def compute_losses(self, batch, loss_string):
-        signals, targets = self.remove_padding(batch[0], batch[1])
-        metadatas = batch[2]
-
-        vars = []
-        root_preds, quality_preds, regularizers, root_losses, quality_losses = [], [], [], [], []
-        for signal, target, metadata in zip(signals, targets, metadatas):
-            # vars for this particular batch
-            vb = {}
-            vb['root_pred'], vb['quality_pred'], vb['regularizer'] = self.forward(signal)
-
-            has_encoding = (target[:, 0] != music_utils.NO_ENCODING).nonzero(as_tuple=True)[0]
-            root_pred, quality_pred = \
-                vb['root_pred'][has_encoding, :], vb['quality_pred'][has_encoding, :]
-            root_true, quality_true = target[has_encoding, 0], target[has_encoding, 1]
-            vb['quality_pred_proc'], vb['quality_true_proc'] = quality_pred, quality_true
-
-            if self.data_props.encoding.qualities[0] == 'N':
-                has_root = (quality_true != 0).nonzero(as_tuple=True)[0]
-                root_pred = root_pred[has_root, :]
-                root_true = root_true[has_root]
-            vb['root_pred_proc'], vb['root_true_proc'] = root_pred, root_true
-
-            if torch.numel(root_pred) > 0:
-                vb['root_loss'] = self.loss_func(root_pred, root_true)
-                vb['root_acc'] = self.compute_accuracy(root_pred, root_true)
-            else:
-                # We might have zero elements if all chord qualities are X or N
-                scalar_to_tensor = lambda x: torch.tensor(x).to(self.device)
-                vb['root_loss'], vb['root_acc'] = scalar_to_tensor(0.0), scalar_to_tensor(1.0)
-
-            vb['quality_loss'] = self.loss_func(quality_pred, quality_true)
-            vb['quality_acc'] = self.compute_accuracy(quality_pred, quality_true)
-
-            vb['chords_pred'] = self.get_chord_strings(
-                torch.max(vb['root_pred'], 1)[1], torch.max(vb['quality_pred'], 1)[1])
-            vb['chords_true'] = self.get_chord_strings(target[:, 0], target[:, 1])
-
-            vb['beats'] = metadata['beats']
-            vb['song'] = metadata['song']
-
-            vb['signal'] = signal
-            vb['target'] = target
-
-            vars.append(vb)
-
-        vars = list_utils.list_dict_swap(vars)
-
-        for var in ['root_loss', 'quality_loss', 'regularizer']:
-            vars[var] = sum(vars[var])
-
-        for var in ['root_acc', 'quality_acc']:
-            vars[var] = sum(vars[var]) / len(vars[var])
+        signals, targets, metadatas = batch[0], batch[1], batch[2]
+        # pad_collate carries the song lengths, batches without them are padded to the end
+        lengths = batch[3] if len(batch) > 3 else self.sequence_lengths(targets)
+        frames = torch.arange(targets.shape[1], device=targets.device)
+        is_frame = frames.unsqueeze(0) < lengths.unsqueeze(1)
+
+        root_pred, quality_pred, regularizer = self.forward(signals, lengths)
+
+        root_true, quality_true = targets[:, :, 0], targets[:, :, 1]
+        has_encoding = is_frame & (root_true != music_utils.NO_ENCODING) & \
+                       (root_true != music_utils.CONTEXT)
+        has_root = has_encoding
+        if self.data_props.encoding.qualities[0] == 'N':
+            has_root = has_encoding & (quality_true != 0)
+
+        vars = {}
+        vars['root_loss'], vars['root_acc'] = \
+            self.masked_loss_and_accuracy(root_pred, root_true, has_root)
+        vars['quality_loss'], vars['quality_acc'] = \
+            self.masked_loss_and_accuracy(quality_pred, quality_true, has_encoding)
+        vars['regularizer'] = regularizer
 
         vars[loss_string] = vars['root_loss'] + vars['quality_loss'] + vars['regularizer']
 
         # For the model checkpointing
         self.log(loss_string, vars[loss_string])
 
-        return vars
-
-    def remove_padding(self, signals_padded, targets_padded):
-        """Removes padding from list of signal and target tensors."""
-        signals, targets = [], []
-        for signal, target in zip(signals_padded, targets_padded):
-            padding_locs = (target[:, 0] == music_utils.PADDED).nonzero().flatten().tolist()
-            padding_start = target.shape[0] if len(padding_locs) == 0 else padding_locs[0]
+        metrics = self.epoch_metrics[self.STAGES[loss_string]]
+        metrics.add_scalars({'loss' if key == loss_string else key: value
+                             for (key, value) in vars.items()})
+
+        # Confusion matrices and figures only cover untransposed songs
+        root_classes, quality_classes = torch.max(root_pred, -1)[1], torch.max(quality_pred, -1)[1]
+        zero_shift = torch.tensor(['(+0)' in metadata['song'] for metadata in metadatas],
+                                  device=targets.device).unsqueeze(1)
+        metrics.add_confusion('root', root_true[has_root & zero_shift],
+                              root_classes[has_root & zero_shift])
+        metrics.add_confusion('quality', quality_true[has_encoding & zero_shift],
+                              quality_classes[has_encoding & zero_shift])
+
+        def make_song(i, length, metadata):
+            return {'chords_pred': self.get_chord_strings(root_classes[i, :length],
+                                                          quality_classes[i, :length]),
+                    'chords_true': self.get_chord_strings(root_true[i, :length],
+                                                          quality_true[i, :length]),
+                    'beats': metadata['beats'], 'song': metadata['song'],
+                    'start_time': metadata.get('start_time', 0.0),
+                    'signal': signals[i, :length].detach().cpu()}
+
+        for (i, (length, metadata)) in enumerate(zip(lengths.tolist(), metadatas)):
+            if '(+0)' in metadata['song']:
+                metrics.offer_song(functools.partial(make_song, i, length, metadata))
+
+        # Only the loss is backpropagated, nothing else of the step outputs is kept
+        return {key: value if key == loss_string else value.detach()
+                for (key, value) in vars.items()}
+
+    def masked_loss_and_accuracy(self, pred, true, mask):
+        """Sum of the per song mean losses and mean of the per song accuracies of a batch.
+
+        Songs without any frames in the mask have zero loss and full accuracy; we might have
+        zero elements if all chord qualities are X or N.
+
+        Parameters:
+            pred: B x T x C Tensor of log probabilities.
+            true: B x T Tensor of classes.
+            mask: B x T bool Tensor of the frames to score.
+        """
+        class_n = pred.shape[-1]
+        # Padded and unencoded frames are masked, give them any valid class
+        true = torch.where(mask, true, torch.zeros_like(true))
+
+        losses = self.loss_func(pred.reshape(-1, class_n), true.reshape(-1)).reshape(true.shape)
+        correct = torch.max(pred, -1)[1] == true
+
+        counts = mask.sum(1)
+        has_frames = counts > 0
+        counts = counts.clamp(min=1)
+
+        song_losses = torch.where(mask, losses, torch.zeros_like(losses)).sum(1) / counts
+        song_accs = (correct & mask).sum(1) / counts
+        song_accs = torch.where(has_frames, song_accs, torch.ones_like(song_accs))
+
+        return song_losses.sum(), song_accs.mean()
+
+    def sequence_lengths(self, targets_padded):
+        """Lengths of the sequences in a batch, padding only follows the end of a sequence."""
+        return (targets_padded[:, :, 0] != music_utils.PADDED).sum(1)
 
-            signals.append(signal[:padding_start, :])
-            targets.append(target[:padding_start, :])
-
-        return signals, targets
+    def get_chord_strings(self, root_classes, quality_classes):
+        # root_classes and quality_classes are 1D tensors
+        encoding = self.data_props.encoding
+        return [encoding.chord_string(root, quality)
+                for (root, quality) in zip(root_classes.tolist(), quality_classes.tolist())]
 
-    def compute_accuracy(self, pred, targets):
-        return self.get_correct_entries(pred, targets).sum() / (pred.shape[0])
 
-    def get_correct_entries(self, pred, targets):
-        _, pred_class = torch.max(pred, 1)
-        return (pred_class == targets)
+    def on_train_epoch_start(self):
+        self.epoch_metrics['Train'].reset()
 
-    def get_chord_strings(self, root_classes, quality_classes):
-        # root_classes and quality_classes are 1D tensors
-        chords = []
-        for (root, quality) in zip(root_classes, quality_classes):
-            chords.append(Chord(root, quality).string_encoding(self.data_props.encoding))
-        return chords
+    def on_validation_epoch_start(self):
+        self.epoch_metrics['Valid'].reset()
 
+    def on_test_epoch_start(self):
+        self.epoch_metrics['Test'].reset()
 
-    def training_epoch_end(self, outputs):
-        self.log_outputs(outputs, 'Train')
+    def on_train_epoch_end(self):
+        self.log_metrics(self.epoch_metrics['Train'], 'Train')
 
-    def validation_epoch_end(self, outputs):
-        for epoch_out in outputs:
-            epoch_out['loss'] = epoch_out.pop('val_loss')
+    def on_validation_epoch_end(self):
+        self.log_metrics(self.epoch_metrics['Valid'], 'Valid')
 
-        self.log_outputs(outputs, 'Valid')
+    def log_metrics(self, metrics, type_string):
+        if metrics.step_n == 0:
+            return
 
-    def log_outputs(self, outputs, type_string):
         experiment = self.logger.experiment
-        losses = self.calc_means(outputs, 'loss')
+        losses = metrics.means(['root_loss', 'quality_loss', 'loss'])
         experiment.add_scalars(f"Loss/{type_string}", losses, self.current_epoch)
 
-        accs = self.calc_means(outputs, 'acc')
+        accs = metrics.means(['root_acc', 'quality_acc'])
         experiment.add_scalars(f"Accuracies/{type_string}", accs, self.current_epoch)
 
-        self.make_song_figures(outputs, type_string)
-        self.make_spectra_figures(outputs, type_string)
-        self.make_confusion_matrices(outputs, type_string)
-
-    def calc_means(self, outputs, in_key):
-        return { key: self.calc_mean(outputs, key) \
-                 for key in outputs[0].keys() if in_key in key}
+        self.make_song_figures(metrics.songs, type_string)
+        self.make_spectra_figures(metrics.songs, type_string)
+        self.make_confusion_matrices(metrics, type_string)
 
-    def calc_mean(self, outputs, key):
-        return torch.stack([x[key] for x in outputs]).mean()
-
-    def make_song_figures(self, outputs, type_string):
+    def make_song_figures(self, songs, type_string):
         experiment = self.logger.experiment
 
-        songs_n = 5
-        fields = ['beats', 'chords_pred', 'chords_true', 'song']
-        plot_data = self.zip_output_fields(outputs, fields)[:songs_n]
+        fields = ['beats', 'chords_pred', 'chords_true', 'song', 'start_time']
+        plot_data = [[song[field] for field in fields] for song in songs]
 
-        for (i, (beat_seq, pred_seq, true_seq, song)) in enumerate(plot_data):
+        for (i, (beat_seq, pred_seq, true_seq, song, start_time)) in enumerate(plot_data):
             # Number of chords per row (1 extra column for True / Pred
             cols_n = min(8, len(true_seq))
             rows_n = min((len(true_seq) // cols_n), 6)
 
-            beat_seq = ['0.00'] + [str(round(beat, 2)) for beat in beat_seq]
+            beat_seq = [f'{start_time:.2f}'] + [str(round(beat, 2)) for beat in beat_seq]
 
             fig, axes = plt.subplots(rows_n, 1)
             if not isinstance(axes, np.ndarray):
@@ -198,23 +217,23 @@ class Model(pl.LightningModule):
             experiment.add_figure(f'A. Chords {type_string}/{i}', fig, self.current_epoch)
 
 
-    def make_spectra_figures(self, outputs, type_string):
+    def make_spectra_figures(self, songs, type_string):
         experiment = self.logger.experiment
 
-        songs_n = 5
-        fields = ['beats', 'chords_pred', 'chords_true', 'song', 'signal']
-        plot_data = self.zip_output_fields(outputs, fields)[:songs_n]
+        fields = ['beats', 'chords_pred', 'chords_true', 'song', 'signal', 'start_time']
+        plot_data = [[song[field] for field in fields] for song in songs]
 
-        for (i, (beat_seq, pred_seq, true_seq, song, signal)) in enumerate(plot_data):
+        for (i, (beat_seq, pred_seq, true_seq, song, signal, start_time)) in enumerate(plot_data):
             signal = signal.cpu()
             start_n = 0 if len(beat_seq) <= 1 else 1
-            chord_n = 10 + start_n
-            beat_seq, pred_seq, true_seq, signal = ([0.0] + beat_seq)[start_n:chord_n+1], \
+            # The end of the last frame is not stored, it is only drawn if it is the only frame
+            chord_n = min(10 + start_n, max(len(beat_seq), 1))
+            beat_seq, pred_seq, true_seq, signal = ([start_time] + beat_seq)[start_n:chord_n+1], \
                 pred_seq[start_n:chord_n], true_seq[start_n:chord_n], signal[start_n:chord_n]
 
             # If data has no beats (single chord), give arbitrary end time
             if len(beat_seq) <= 1:
-                beat_seq = [0.0, 1.0]
+                beat_seq = [start_time, start_time + 1.0]
 
             fig, ax = plt.subplots(1, 1)
             ax.tick_params(width=2)
@@ -259,10 +278,12 @@ class Model(pl.LightningModule):
     def chord_overlay(self, beat_seq, chords, ax, color='r'):
         subdivisions = self.data_props.bin_n // 12
 
+        encoding = self.data_props.encoding
         for i, chord in enumerate(chords):
-            chord = Chord.create_from_string(chord, self.data_props.encoding)
+            root, quality = encoding.string_to_chord(chord)
+            mask = 0 if root == music_utils.NO_ENCODING else encoding.note_masks[root, quality]
 
-            notes = [(n * subdivisions) % self.data_props.bin_n for n in chord.notes(self.data_props.encoding)]
+            notes = [note * subdivisions for note in range(12) if (mask >> note) & 1]
             notes_octaves = []
             for j in range(self.data_props.octave_n):
                 notes_octaves += [n + j * self.data_props.bin_n for n in notes]
@@ -272,27 +293,12 @@ class Model(pl.LightningModule):
                     linewidth=2, edgecolor=color, facecolor='none'))
 
 
-    def make_confusion_matrices(self, outputs, type_string):
+    def make_confusion_matrices(self, metrics, type_string):
         experiment = self.logger.experiment
 
-        fields = ['root_pred_proc', 'root_true_proc', 'quality_pred_proc', 'quality_true_proc']
-        data = self.zip_output_fields(outputs, fields, zero_shift=True)
-
-        root_n = self.data_props.encoding.root_n()
-        qual_n = self.data_props.encoding.quality_n()
-        root_confusion, quality_confusion = np.zeros((root_n, root_n)), np.zeros((qual_n, qual_n))
-
-        for (root_pred, root_true, quality_pred, quality_true) in data:
-            if torch.numel(root_pred) > 0:
-                root_pred = torch.max(root_pred, 1)[1]
-                # Rows correspond to true labels, columns are predicted
-                root_confusion += confusion_matrix(root_true.cpu(), root_pred.cpu(),
-                                                   labels=list(range(root_n)))
-
-            quality_pred = torch.max(quality_pred, 1)[1]
-            quality_confusion += confusion_matrix(quality_true.cpu(), quality_pred.cpu(),
-                                                  labels=list(range(qual_n)))
-
+        # Rows correspond to true labels, columns are predicted
+        root_confusion = metrics.confusion('root').cpu().numpy()
+        quality_confusion = metrics.confusion('quality').cpu().numpy()
 
         fig = self.plot_confusion_matrix(root_confusion, self.data_props.encoding.roots)
         experiment.add_figure(f'C. Confusion Root/{type_string}', fig, self.current_epoch)
@@ -331,24 +337,6 @@ class Model(pl.LightningModule):
         return fig
 
 
-    def zip_output_fields(self, outputs, fields, ignore_augment=True, zero_shift=True):
-        not_augmented = list_utils.flatten_top([o['song'] for o in outputs])
-        if zero_shift:
-            not_augmented = [i for (i, na) in enumerate(not_augmented) if '(+0)' in na]
-        else:
-            not_augmented = [i for (i, na) in enumerate(not_augmented)]
-
-        output_fields = []
-        for field in fields:
-            field_outputs = list_utils.flatten_top([o[field] for o in outputs])
-            if ignore_augment:
-                output_fields.append([field_outputs[i] for i in not_augmented])
-            else:
-                output_fields.append(field_outputs)
-
-        return list(zip(*output_fields))
-
-
     def configure_optimizers(self):
         optimizer = torch.optim.SGD(self.parameters(), lr=1e-3, weight_decay=1e-3)
         return optimizer
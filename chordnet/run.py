@@ -13,7 +13,6 @@ from pytorch_lightning.callbacks import ModelCheckpoint
 
 from chordnet.data import ChordDataModule, DatasetType, DataProperties
 from chordnet.utils import dirs, file_utils
-from chordnet.utils.music_utils import Chord
 from chordnet.models.mlp import MLP
 from chordnet.models.mlp_rnn import MLPRNN
 from chordnet.models.convnet import ConvNet
@@ -27,11 +26,14 @@ import pdb
 @click.argument('checkpoint')
 @click.argument('song')
 
-def run(checkpoint, song):
+@click.option('--extractor', default='dct', type=click.Choice(ChordDataModule.EXTRACTORS),
+              help='Spectral feature extractor, must match the one the model was trained on.')
+
+def run(checkpoint, song, extractor):
     model = ChordNet.load_from_checkpoint(checkpoint)
 
     # Create a dummy data module, we're only using the parse_spectra_song function
-    data = ChordDataModule(DatasetType.BILLBOARD_MAJMIN7_ALL, False)
+    data = ChordDataModule(DatasetType.BILLBOARD_MAJMIN7_ALL, False, extractor=extractor)
     song_data = data.parse_spectra_song(song, read_annotations=False)
 
     bin_n = model.data_props.bin_n
@@ -43,9 +45,9 @@ def run(checkpoint, song):
     _, root_classes = torch.max(roots, 1)
     _, quality_classes = torch.max(qualities, 1)
 
-    chords = []
-    for (root, quality) in zip(root_classes, quality_classes):
-        chords.append(Chord(root, quality).string_encoding(model.data_props.encoding))
+    encoding = model.data_props.encoding
+    chords = [encoding.chord_string(root, quality)
+              for (root, quality) in zip(root_classes.tolist(), quality_classes.tolist())]
 
     annot = [str(c) for c in zip([0] + song_data['beats'], chords)]
     print('\n'.join(annot))
@@ -0,0 +1,276 @@
+import torch
+import numpy as np
+import random
+import time
+import json
+import click
+
+from dataclasses import dataclass
+from typing import List
+
+from chordnet.data import ChordDataModule, DatasetType
+from chordnet.utils.audio_utils import Audio
+from chordnet.utils.tempo import StreamingBeatTracker
+from chordnet.models.chordnet import ChordNet
+
+import pdb
+
+
+@dataclass
+class StreamedChord():
+    start: float # Beat start in seconds since the start of the stream
+    end: float # Beat end in seconds since the start of the stream
+    chord: str
+    latency: float # Seconds from the end of the beat's audio until the chord was emitted
+
+
+class StreamingChordRecognizer():
+    PCM_SCALE = 2 * 32767 # Training audio is the sum of two int16 channels
+    MAX_BEAT_SECONDS = 3.0 # Beats are closed after this long without a detected beat
+    # cqt pools a spectrogram of the whole song whose frames span seconds of audio around every
+    # beat, spectra of the audio of single beats are too far off the offline features
+    EXTRACTORS = ['dct']
+
+    def __init__(self, model, data: ChordDataModule, sample_rate=44100, seed=0):
+        """Recognizes chords in live audio, fed in blocks of mono samples.
+
+        Beats are tracked causally with a StreamingBeatTracker. When a beat closes, its spectrum
+        is extracted from the buffered audio of the beat. A beat's chord is emitted once the
+        model's look-ahead of future beats has closed as well. ChordNet infers incrementally
+        (see ChordNet.step); other models are run over the window of beats they see. For models
+        looking at a fixed window of beats these are the same chords as offline, except that
+        every spectrum is normalized by the running maximum when its beat closes instead of the
+        maximum over the whole song.
+
+        Arguments:
+            model: a trained model.
+            data: data module providing the spectral feature extractor, e.g. a
+                ChordDataModule(..., fetch_data=False) with the model's extractor, which must
+                be one of EXTRACTORS.
+            sample_rate: sampling frequency of the fed samples.
+            seed: seeds the random subwindows of the spectra.
+        """
+        if data.extractor not in self.EXTRACTORS:
+            raise ValueError(f'Streaming does not support the {data.extractor} extractor, '
+                             f'only {", ".join(self.EXTRACTORS)}')
+
+        self.model = model.eval()
+        self.data = data
+        self.sample_rate = sample_rate
+        self.rng = random.Random(seed)
+
+        self.incremental = hasattr(model, 'step')
+        inclusions = getattr(model, 'history_inclusions', [0])
+        self.history = -min(inclusions)
+        self.lookahead = max(inclusions)
+
+        self.octaves = list(range(data.START_OCTAVE - 1,
+                                  data.START_OCTAVE + data.props.octave_n + 1))
+        self.tracker = StreamingBeatTracker(sample_rate=sample_rate)
+        self.reset()
+
+    def reset(self):
+        """Starts a new stream."""
+        self.tracker.reset()
+        self.sample_n = 0 # Samples fed so far
+        self.beat_start = 0.0 # Start of the beat which has not closed yet
+        self.beat_samples = [] # Blocks fed since the start of the open beat
+
+        self.spectra = [] # Window of the spectra the model sees for the next emitted beat
+        self.beats = [] # (start, end) of the closed beats not emitted yet
+        self.outputs = [] # Incremental model outputs for the beats not emitted yet
+        self.next_emitted = 0 # Index of the next beat to emit
+        self.closed_n = 0 # Number of beats closed so far
+        self.spectra_max = 0.0
+        if self.incremental:
+            self.model.start_stream()
+
+    def position(self) -> float:
+        """Seconds of audio fed since the start of the stream."""
+        return self.sample_n / self.sample_rate
+
+    def process(self, block) -> List[StreamedChord]:
+        """Feeds a block of mono samples scaled to [-1, 1].
+
+        Returns:
+            The chords of the beats which became available with this block, in order.
+        """
+        call_start = time.perf_counter()
+        block = np.asarray(block, dtype=np.float32)
+
+        self.beat_samples.append(block)
+        self.sample_n += len(block)
+
+        chords = []
+        boundaries = [beat for beat in self.tracker.process(block) if beat > self.beat_start]
+        for boundary in boundaries + [None]:
+            # Force boundaries in long stretches without beats to keep the audio buffer bounded
+            until = self.position() if boundary is None else boundary
+            while until - self.beat_start > self.MAX_BEAT_SECONDS:
+                self.close_beat(self.beat_start + self.MAX_BEAT_SECONDS)
+                chords += self.emit(call_start, flushing=False)
+
+            if boundary is not None:
+                self.close_beat(boundary)
+                chords += self.emit(call_start, flushing=False)
+        return chords
+
+    def flush(self) -> List[StreamedChord]:
+        """Closes the last beat at the end of the stream and emits all remaining chords."""
+        call_start = time.perf_counter()
+        if self.position() > self.beat_start:
+            self.close_beat(self.position())
+        return self.emit(call_start, flushing=True)
+
+    def close_beat(self, end: float) -> None:
+        samples = np.concatenate(self.beat_samples) if self.beat_samples else np.zeros(0)
+        buffer_start = self.position() - len(samples) / self.sample_rate
+
+        # Extract the beat and keep the audio after it for the next beat
+        split = min(int(round((end - buffer_start) * self.sample_rate)), len(samples))
+        beat, rest = samples[:split], samples[split:]
+        self.beat_samples = [rest]
+
+        spectrum = self.data.parse_spectra_beats(beat * self.PCM_SCALE, self.sample_rate,
+            self.octaves, [0.0, len(beat) / self.sample_rate], rng=self.rng)[0].flatten()
+        self.push_spectrum(self.beat_start, end, spectrum)
+        self.beat_start = end
+
+    def push_spectrum(self, start: float, end: float, spectrum: np.ndarray) -> None:
+        """Adds the spectrum of the next closed beat, covering start to end seconds."""
+        self.spectra_max = max(self.spectra_max, float(np.max(spectrum)))
+        spectrum = spectrum / (self.spectra_max or 1.0)
+        self.beats.append((start, end))
+        self.closed_n += 1
+
+        if self.incremental:
+            bin_n = self.data.props.bin_n
+            spectrum = torch.from_numpy(spectrum).type(torch.FloatTensor)[bin_n:-bin_n]
+            output = self.model.step(spectrum)
+            if output is not None:
+                self.outputs.append(output)
+        else:
+            self.spectra.append(spectrum)
+
+    def emit(self, call_start: float, flushing: bool) -> List[StreamedChord]:
+        """Emits the chords of all beats whose look-ahead has closed (or all beats if flushing)."""
+        if self.incremental:
+            if flushing:
+                self.outputs += self.model.flush()
+            outputs, self.outputs = self.outputs, []
+            return [self.emit_chord(roots[0], qualities[0], call_start)
+                    for (roots, qualities) in outputs]
+
+        chords = []
+        while self.next_emitted < self.closed_n and \
+                (flushing or self.next_emitted + self.lookahead < self.closed_n):
+            # The spectra window starts history beats before the emitted one, if there are any
+            offset = self.next_emitted - (self.closed_n - len(self.spectra))
+            roots, qualities = self.predict(np.stack(self.spectra[:offset + self.lookahead + 1]))
+            chords.append(self.emit_chord(roots[offset], qualities[offset], call_start))
+
+            # Drop spectra which fell out of the history of the next beat to emit
+            while self.next_emitted - (self.closed_n - len(self.spectra)) > self.history:
+                self.spectra.pop(0)
+        return chords
+
+    def emit_chord(self, roots, qualities, call_start: float) -> StreamedChord:
+        start, end = self.beats.pop(0)
+        self.next_emitted += 1
+
+        chord = self.data.props.encoding.chord_string(torch.argmax(roots).item(),
+                                                      torch.argmax(qualities).item())
+        latency = self.position() - end + time.perf_counter() - call_start
+        return StreamedChord(start, end, chord, latency)
+
+    def predict(self, window: np.ndarray):
+        bin_n = self.data.props.bin_n
+        spectra = torch.from_numpy(window).type(torch.FloatTensor)[:, bin_n:-bin_n]
+
+        with torch.no_grad():
+            roots, qualities, _ = self.model(spectra)
+        return roots, qualities
+
+
+def stream_song(recognizer: StreamingChordRecognizer, song: str, block_size: int):
+    """Streams a wav file through the recognizer in blocks, as if it were live audio."""
+    audio = Audio.read(song)
+    assert audio.sample_rate == recognizer.sample_rate
+    samples = audio.normalized()
+
+    chords = []
+    for start in range(0, len(samples), block_size):
+        chords += recognizer.process(samples[start:start + block_size])
+    return chords + recognizer.flush()
+
+
+def serve(recognizer: StreamingChordRecognizer, port: int):
+    """Serves a local websocket like misc/gen/server.js.
+
+    Binary messages carry float32 mono samples, a text message ends the stream. Every emitted
+    chord is sent back as a JSON text message.
+    """
+    import asyncio
+    # Only needed for live input, so not a hard dependency
+    import websockets
+
+    async def handle(websocket, path=None):
+        recognizer.reset()
+        async for message in websocket:
+            if isinstance(message, bytes):
+                chords = recognizer.process(np.frombuffer(message, dtype=np.float32))
+            else:
+                chords = recognizer.flush()
+
+            for chord in chords:
+                print(format_chord(chord))
+                await websocket.send(json.dumps(chord.__dict__))
+
+            if not isinstance(message, bytes):
+                recognizer.reset()
+
+    async def main():
+        async with websockets.serve(handle, 'localhost', port):
+            await asyncio.Future()
+
+    asyncio.run(main())
+
+
+def format_chord(chord: StreamedChord) -> str:
+    return f'{chord.start:7.2f} {chord.end:7.2f} {chord.chord:8} latency {chord.latency:.3f}s'
+
+
+@click.command()
+
+@click.argument('checkpoint')
+@click.argument('song', required=False)
+
+@click.option('--extractor', default='dct',
+              type=click.Choice(StreamingChordRecognizer.EXTRACTORS),
+              help='Spectral feature extractor, must match the one the model was trained on. '
+                   'Models trained on cqt features can not be streamed, use run.py instead.')
+@click.option('--block_size', default=1024, help='Samples per block when streaming a song.')
+@click.option('--sample_rate', default=44100, help='Sampling frequency of the live audio.')
+@click.option('--port', default=8081, help='Websocket port for live audio, without a song.')
+
+def stream(checkpoint, song, extractor, block_size, sample_rate, port):
+    model = ChordNet.load_from_checkpoint(checkpoint)
+
+    # Create a dummy data module, we're only using its spectral feature extraction
+    data = ChordDataModule(DatasetType.BILLBOARD_MAJMIN7_ALL, False, extractor=extractor)
+    recognizer = StreamingChordRecognizer(model, data, sample_rate=sample_rate)
+
+    if song is None:
+        serve(recognizer, port)
+        return
+
+    chords = stream_song(recognizer, song, block_size)
+    print('\n'.join(format_chord(chord) for chord in chords))
+
+    latencies = np.array([chord.latency for chord in chords])
+    if len(latencies) > 0:
+        print(f'Latency per beat: mean {latencies.mean():.3f}s, max {latencies.max():.3f}s')
+
+
+if __name__ == "__main__":
+    stream()
@@ -0,0 +1,52 @@
+import unittest
+import random
+
+import numpy as np
+
+from chordnet.utils import annotation_utils
+
+import pdb
+
+class AnnotationUtilsTest(unittest.TestCase):
+    def check_parity(self, annotations, beats):
+        expected = [annotation_utils.best_match(annotations, start, end)
+                    for (start, end) in zip(beats[:-1], beats[1:])]
+        self.assertEqual(annotation_utils.best_matches(annotations, beats), expected)
+
+    def test_best_matches_parity(self):
+        rng = random.Random(0)
+        chords = [(root, quality) for root in range(3) for quality in range(2)]
+
+        for _ in range(20):
+            # Back to back annotations, like the MIREX lab files
+            times = np.cumsum([rng.uniform(0.2, 3.0) for _ in range(40)]).tolist()
+            annotations = [(rng.choice(chords), start, end)
+                           for (start, end) in zip([0.0] + times[:-1], times)]
+            beats = [0.0] + np.cumsum([rng.uniform(0.3, 0.7) for _ in range(150)]).tolist()
+            self.check_parity(annotations, beats)
+
+            # Unsorted, overlapping annotations with gaps, and beats outside of all of them
+            annotations = []
+            for _ in range(30):
+                start = rng.uniform(5.0, 60.0)
+                annotations.append((rng.choice(chords), start, start + rng.uniform(0.0, 8.0)))
+            self.check_parity(annotations, beats)
+
+    def test_best_matches_ties(self):
+        # Equal overlaps resolve to the chord annotated first, like best_match
+        annotations = [((1, 0), 1.0, 2.0), ((2, 0), 0.0, 1.0), ((1, 0), 5.0, 6.0)]
+        self.check_parity(annotations, [0.5, 1.5, 3.0, 4.0, 5.0, 8.0])
+        self.assertEqual(annotation_utils.best_matches(annotations, [0.5, 1.5]), [(1, 0)])
+        self.assertEqual(annotation_utils.best_matches(annotations, [3.0, 4.0]), [(1, 0)])
+
+    def test_nearest_distances(self):
+        rng = np.random.default_rng(0)
+        beats = np.sort(rng.uniform(0, 100, 200))
+        times = rng.uniform(-5, 105, 300)
+
+        expected = [min([abs(b - t) for b in beats]) for t in times]
+        np.testing.assert_allclose(annotation_utils.nearest_distances(times, beats), expected)
+        np.testing.assert_allclose(annotation_utils.nearest_distances([3.0], [1.0]), [2.0])
+
+if __name__ == '__main__':
+    unittest.main()
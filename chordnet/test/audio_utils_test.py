@@ -0,0 +1,70 @@
+import unittest
+import tempfile
+import os.path as op
+
+import numpy as np
+from scipy.io import wavfile
+
+from chordnet.utils.audio_utils import Audio
+
+import pdb
+
+class AudioUtilsTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def write(self, name, data, sample_rate=8000):
+        path = op.join(self.root.name, name)
+        wavfile.write(path, sample_rate, data)
+        return path
+
+    def test_stereo_int16(self):
+        data = np.array([[32767, 32767], [-32768, -32768], [1000, -3000], [0, 5]], dtype=np.int16)
+        audio = Audio.read(self.write('stereo.wav', data))
+
+        self.assertEqual((audio.sample_rate, audio.channel_n, audio.full_scale), (8000, 2, 32767))
+        np.testing.assert_array_equal(audio.samples, [65534, -65536, -2000, 5])
+        # Channels are summed in float, full scale negative samples don't wrap around
+        np.testing.assert_allclose(audio.normalized(),
+                                   [1.0, -32768 / 32767, -1000 / 32767, 2.5 / 32767], rtol=1e-6)
+        self.assertEqual(audio.normalized().dtype, np.float32)
+        self.assertAlmostEqual(audio.duration(), 4 / 8000)
+
+    def test_mono_int16(self):
+        data = np.array([-32768, -1, 0, 16384], dtype=np.int16)
+        audio = Audio.read(self.write('mono.wav', data), name='song')
+
+        self.assertEqual((audio.channel_n, audio.name), (1, 'song'))
+        np.testing.assert_allclose(audio.normalized(), data / 32767, rtol=1e-6)
+
+    def test_float32(self):
+        data = np.array([[0.5, -0.25], [-1.0, 1.0], [0.125, 0.0]], dtype=np.float32)
+        audio = Audio.read(self.write('float.wav', data))
+
+        self.assertEqual((audio.full_scale, audio.channel_n), (1.0, 2))
+        np.testing.assert_allclose(audio.normalized(), [0.125, 0.0, 0.0625])
+
+    def test_mmap(self):
+        data = np.random.rand(1000).astype(np.float32) * 2 - 1
+        path = self.write('mmap.wav', data)
+
+        audio = Audio.read(path, mmap=True)
+        # Mono float32 samples are used in place
+        self.assertIsInstance(audio.samples, np.memmap)
+        np.testing.assert_array_equal(audio.normalized(), data)
+
+        with open(path, 'rb') as file:
+            in_memory = Audio.read(file.read())
+        np.testing.assert_array_equal(in_memory.normalized(), audio.normalized())
+
+        # Integer sources are still mixed into memory
+        stereo = Audio.read(self.write('mmap_stereo.wav', np.zeros((10, 2), dtype=np.int16)),
+                            mmap=True)
+        self.assertNotIsInstance(stereo.samples, np.memmap)
+        self.assertEqual(stereo.samples.dtype, np.float32)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+import os
+import tempfile
+import pickle
+
+import numpy as np
+
+from chordnet.utils import cache_utils
+
+import pdb
+
+class CacheUtilsTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def test_get_put(self):
+        cache = cache_utils.FeatureCache(self.root.name)
+        self.assertIsNone(cache.get('beats', 'a'))
+
+        cache.put('beats', 'a', (120.0, np.arange(4.0)))
+        bpm, beats = cache.get('beats', 'a')
+        self.assertEqual(bpm, 120.0)
+        np.testing.assert_array_equal(beats, np.arange(4.0))
+
+    def test_lru_eviction(self):
+        value = np.zeros(100)
+        entry_size = len(pickle.dumps(value))
+        cache = cache_utils.FeatureCache(self.root.name, size_limits={'beats': 3 * entry_size})
+
+        for (i, key) in enumerate(['a', 'b', 'c']):
+            cache.put('beats', key, value)
+            os.utime(cache.path('beats', key), (i, i))
+
+        # Reading 'a' makes 'b' the least recently used entry
+        cache.get('beats', 'a')
+        cache.put('beats', 'd', value)
+
+        self.assertIsNone(cache.get('beats', 'b'))
+        for key in ['a', 'c', 'd']:
+            self.assertIsNotNone(cache.get('beats', key))
+
+    def test_unlimited_kind(self):
+        cache = cache_utils.FeatureCache(self.root.name, size_limits={'beats': 0})
+        cache.put('chromas', 'a', np.zeros(100))
+        self.assertIsNotNone(cache.get('chromas', 'a'))
+
+if __name__ == '__main__':
+    unittest.main()
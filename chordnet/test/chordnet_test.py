@@ -9,6 +9,16 @@ from chordnet.utils.music_utils import BillboardMajMin7Encoding
 
 import pdb
 
+def rolled_windows(net, x):
+    seq_n = x.shape[0]
+
+    rolls = [net.roll_zeros_seq(x, roll_amount) for roll_amount in net.history_inclusions]
+    x = torch.flip(torch.stack(rolls, 1), (1, ))
+
+    x = x.reshape(-1, 1, x.shape[2])
+    x = net.shared_net(x)
+    return x.reshape(seq_n, -1, x.shape[2])
+
 class ChordNetTest(ttc.TorchTestCase):
     def test_chordnet_equivariant(self):
         octave_n, bin_n = 5, 12
@@ -34,6 +44,56 @@ class ChordNetTest(ttc.TorchTestCase):
                 self.assertEquals(root.roll(i // bins_per_note), root_shift)
                 self.assertEquals(qual, qual_shift)
 
+    def test_history_windows_parity(self):
+        octave_n, bin_n = 5, 12
+        data_props = DataProperties(BillboardMajMin7Encoding(), octave_n, bin_n)
+        net = ChordNet(data_props)
+
+        for seq_n in [1, 4, 6, 11, 30]:
+            x = torch.rand(seq_n, bin_n * octave_n)
+            self.assertEqual(net.history_windows(x), rolled_windows(net, x))
+
+            roots, qualities, _ = net(x)
+            rolled_roots, rolled_qualities = net.classify(rolled_windows(net, x))
+            self.assertEqual(roots, rolled_roots)
+            self.assertEqual(qualities, rolled_qualities)
+
+    def test_roll_dim(self):
+        data_props = DataProperties(BillboardMajMin7Encoding(), 5, 12)
+        net = ChordNet(data_props)
+
+        x = torch.rand(40, 11, 12)
+        roots = torch.randint(12, (40, ))
+        expected = torch.stack([torch.roll(frame, -root, -1)
+                                for (frame, root) in zip(x, roots.tolist())])
+        self.assertEqual(net.roll_dim(x, roots), expected)
+
+        # Batched frames roll by their own roots
+        x, roots = x.reshape(4, 10, 11, 12), roots.reshape(4, 10)
+        self.assertEqual(net.roll_dim(x, roots), expected.reshape(4, 10, 11, 12))
+
+    def test_incremental_parity(self):
+        octave_n, bin_n = 5, 12
+        data_props = DataProperties(BillboardMajMin7Encoding(), octave_n, bin_n)
+        net = ChordNet(data_props)
+
+        for seq_n in [1, 4, 5, 6, 11, 30]:
+            x = torch.rand(seq_n, bin_n * octave_n)
+            with torch.no_grad():
+                roots, qualities, _ = net(x)
+
+            net.start_stream()
+            outputs = [net.step(frame) for frame in x]
+            # The first frames are returned once their future context has arrived
+            lookahead = net.history_inclusions[-1]
+            self.assertTrue(all(output is None for output in outputs[:lookahead]))
+            outputs = [output for output in outputs if output is not None] + net.flush()
+
+            self.assertEqual(len(outputs), seq_n)
+            roots_streamed = torch.cat([output[0] for output in outputs])
+            qualities_streamed = torch.cat([output[1] for output in outputs])
+            self.assertTrue(torch.allclose(roots_streamed, roots, atol=1e-5))
+            self.assertTrue(torch.allclose(qualities_streamed, qualities, atol=1e-5))
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,324 @@
+import unittest
+import random
+import tempfile
+import zipfile
+import io
+import contextlib
+import os.path as op
+from unittest import mock
+
+import numpy as np
+import torch
+from scipy.io import wavfile
+
+from chordnet.data import ChordDataModule, BucketBatchSampler, ChunkedDataset, ListDataset, \
+    TransposedDataset, pad_collate
+from chordnet.utils import dirs, music_utils, store_utils, spectra_utils
+from chordnet.utils.data_utils import DatasetType
+
+import pdb
+
+class DataTest(unittest.TestCase):
+    def setUp(self):
+        self.data = ChordDataModule(DatasetType.BILLBOARD_MAJMIN7_ALL, True)
+        self.f0 = 8000
+        self.audio = np.random.randint(-2000, 2000, size=(5 * self.f0, 2)).astype(np.int16)
+        self.octaves = list(range(-5, 4))
+
+    def test_windows_parity(self):
+        windows = [(0.0, 0.5), (0.25, 0.5), (1.0, 0.37), (2.5, 1.2), (4.8, 0.5)]
+        batched = self.data.parse_spectra_windows(self.audio, self.f0, self.octaves, windows)
+
+        for spectra, (t_start, win) in zip(batched, windows):
+            single = self.data.parse_spectra_window(self.audio, self.f0, self.octaves, t_start, win)
+            np.testing.assert_allclose(spectra, single, rtol=1e-10)
+
+    def test_bin_matrices_reused(self):
+        beats = list(np.arange(0.0, 4.5, 0.5)) + [5.0]
+        spectra_utils.bin_matrix.cache_clear()
+        infos = []
+        for seed in range(2):
+            self.data.parse_spectra_beats(self.audio, self.f0, self.octaves, beats,
+                                          rng=random.Random(seed))
+            infos.append(spectra_utils.bin_matrix.cache_info())
+
+        # The 99 windows of a song share a few lengths, and the second song mostly reuses them
+        self.assertLess(infos[0].misses, 25)
+        self.assertGreater(infos[1].hits, 3 * (infos[1].misses - infos[0].misses))
+
+    def test_pooled_beats_aligned(self):
+        data = ChordDataModule(DatasetType.BILLBOARD_MAJMIN7_ALL, True, extractor='cqt')
+        f0, octaves, bin_n = 22050, [-2, -1, 0, 1], data.props.bin_n
+        # One tone per beat, beats are not aligned with the hops of the spectrogram
+        beats = [0.0, 0.7, 1.45, 2.3, 3.0]
+        semitones = [0, 7, 3, 10]
+
+        t = np.arange(int(beats[-1] * f0)) / f0
+        tones = np.searchsorted(beats, t, side='right') - 1
+        audio = np.sin(2 * np.pi * 440 * 2**(np.array(semitones)[tones] / 12) * t)
+
+        spectra = data.parse_spectra_beats(audio, f0, octaves, beats)
+        self.assertEqual(spectra.shape, (len(beats) - 1, len(octaves), bin_n))
+        for (spectrum, semitone) in zip(spectra, semitones):
+            octave, bin = np.unravel_index(np.argmax(spectrum), spectrum.shape)
+            self.assertEqual((octaves[octave], bin), (0, semitone * bin_n // 12))
+
+    def test_extractor_metadata(self):
+        with tempfile.TemporaryDirectory() as root, \
+             mock.patch.object(dirs, 'data_path', lambda *path: op.join(root, *path)):
+            dataset_type = DatasetType.BILLBOARD_MAJMIN7_ALL
+            ChordDataModule(dataset_type, True, extractor='cqt').write_metadata(
+                {'dataset_type': dataset_type, 'extractor': 'cqt'})
+
+            # Runs without a fetch keep the extractor of the stored features
+            data = ChordDataModule(dataset_type, False)
+            self.assertEqual(data.extractor, 'cqt')
+            data.check_extractor()
+            self.assertEqual(data.read_metadata()['extractor'], 'cqt')
+
+            with self.assertRaises(RuntimeError):
+                ChordDataModule(dataset_type, False, extractor='dct').check_extractor()
+            self.assertEqual(ChordDataModule(None, False).extractor, 'cqt')
+
+    def test_setup_rejects_incomplete_store(self):
+        with tempfile.TemporaryDirectory() as root, \
+             mock.patch.object(dirs, 'data_path', lambda *path: op.join(root, *path)):
+            # Interrupted fetch, the store was never closed
+            store_utils.FeatureStoreWriter(dirs.data_path('store'))
+            with self.assertRaises(RuntimeError):
+                ChordDataModule(DatasetType.BILLBOARD_MAJMIN7_ALL, False).setup()
+
+            # Fetch without any parsed song
+            store_utils.FeatureStoreWriter(dirs.data_path('store')).close()
+            with self.assertRaises(RuntimeError):
+                ChordDataModule(DatasetType.BILLBOARD_MAJMIN7_ALL, False).setup()
+
+    def test_parse_all_spectra_workers(self):
+        chords = ['Cmaj', 'Amin', 'Gmaj', 'Ebmaj', 'Fmin']
+        with tempfile.TemporaryDirectory() as root, \
+             mock.patch.object(dirs, 'data_path', lambda *path: op.join(root, *path)), \
+             mock.patch.object(ChordDataModule, 'dataset_zip', lambda self: op.join(root, 'g.zip')):
+            with zipfile.ZipFile(op.join(root, 'g.zip'), 'w') as zip_ref:
+                for (i, chord) in enumerate(chords):
+                    wav_bytes = io.BytesIO()
+                    wavfile.write(wav_bytes, self.f0, np.roll(self.audio, 1000 * i, axis=0))
+                    zip_ref.writestr(f'generated/{chord}-{i}.wav', wav_bytes.getvalue())
+                    if i == 2:
+                        zip_ref.writestr('generated/Dmaj-bad.wav', b'RIFF not a wav')
+
+            stores = []
+            for workers in [1, 2]:
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    ChordDataModule(DatasetType.GENERATED, True,
+                                    workers=workers).parse_all_spectra()
+                self.assertIn('Got exception on parsing generated/Dmaj-bad.wav', output.getvalue())
+                store = store_utils.FeatureStore(dirs.data_path('store'))
+                stores.append(([song for (song, ) in store.query('SELECT song FROM songs')],
+                               store.signals(range(len(store))), store.targets(range(len(store)))))
+
+            for (songs, signals, targets) in stores:
+                self.assertEqual(songs, [f'{chord}-{i}' for (i, chord) in enumerate(chords)])
+                for i in range(len(songs)):
+                    self.assertTrue(torch.equal(signals[i], stores[0][1][i]))
+                    self.assertTrue(torch.equal(targets[i], stores[0][2][i]))
+
+    def test_read_audio_from_zip(self):
+        with tempfile.TemporaryDirectory() as root:
+            path = op.join(root, 'song.wav')
+            wavfile.write(path, self.f0, self.audio)
+            with zipfile.ZipFile(op.join(root, 'songs.zip'), 'w') as zip_ref:
+                zip_ref.write(path, 'songs/song.wav')
+
+            zipped, zipped_hash = self.data.read_audio('songs/song.wav', op.join(root, 'songs.zip'))
+            audio, audio_hash = self.data.read_audio(path)
+
+            self.assertEqual(zipped.sample_rate, audio.sample_rate)
+            np.testing.assert_array_equal(zipped.samples, audio.samples)
+            np.testing.assert_array_equal(zipped.normalized(), audio.normalized())
+            self.assertEqual(zipped.name, 'song.wav')
+            self.assertEqual(zipped_hash, audio_hash)
+
+    def test_repeated_parity(self):
+        t_start, win = 1.3, 0.6
+
+        random.seed(0)
+        repeated = self.data.parse_spectra_repeated(self.audio, self.f0, self.octaves, t_start, win)
+
+        random.seed(0)
+        windows = [(t_start, win)] + self.data.random_subwindows(t_start, win)
+        spectra = sum(self.data.parse_spectra_window(self.audio, self.f0, self.octaves, s, w)
+                      for (s, w) in windows) / len(windows)
+
+        np.testing.assert_allclose(repeated, spectra, rtol=1e-10)
+
+    def test_bucket_batch_sampler(self):
+        lengths = [5, 250, 120, 480, 310, 90, 260, 700, 199, 200, 330, 410]
+        boundaries = [200, 300, 400]
+        sampler = BucketBatchSampler(lengths, 2, boundaries, seed=1)
+
+        epochs = [list(sampler), list(sampler)]
+        self.assertNotEqual(epochs[0], epochs[1])
+        for batches in epochs:
+            self.assertEqual(len(batches), len(sampler))
+            self.assertEqual(sorted(i for batch in batches for i in batch),
+                             list(range(len(lengths))))
+            for batch in batches:
+                self.assertLessEqual(len(batch), 2)
+                buckets = np.searchsorted(boundaries, [lengths[i] for i in batch], side='right')
+                self.assertEqual(len(set(buckets)), 1)
+
+        ordered = list(BucketBatchSampler(lengths, 3, boundaries, shuffle=False))
+        self.assertEqual(ordered, [[0, 2, 5], [8], [1, 6, 9], [4, 10], [3, 7, 11]])
+
+    def test_sampler_lengths_without_items(self):
+        props = self.data.props
+        song_lengths = [250, 40, 610, 90]
+        signals = [torch.rand(n, (props.octave_n + 2) * props.bin_n) for n in song_lengths]
+        targets = [torch.zeros(n, 2, dtype=torch.long) for n in song_lengths]
+        metadatas = [{'song': f'song{i}', 'beats': []} for i in range(len(song_lengths))]
+
+        with mock.patch.object(ListDataset, '__getitem__', side_effect=AssertionError):
+            dataset = TransposedDataset(ListDataset(signals, targets, metadatas,
+                                                    lengths=song_lengths), range(-6, 6), props)
+            self.data.train_data = ChunkedDataset(dataset, 200, 5)
+            self.data.batch_size = 4
+            batches = list(self.data.train_dataloader().batch_sampler)
+
+        lengths = self.data.train_data.lengths()
+        self.assertEqual(sorted(i for batch in batches for i in batch),
+                         list(range(len(self.data.train_data))))
+        self.assertEqual(lengths[:3], [195, 65, 40])
+
+    def test_pad_collate_lengths(self):
+        songs = [(torch.rand(n, 4), torch.zeros(n, 2, dtype=torch.long), {}) for n in [3, 7, 5]]
+        signals, targets, metadatas, lengths = pad_collate(songs)
+
+        self.assertEqual(signals.shape, (3, 7, 4))
+        self.assertEqual(lengths.tolist(), [3, 7, 5])
+
+    def test_chunked_dataset(self):
+        lengths = [3, 10, 23]
+        signals = [torch.rand(n, 4) for n in lengths]
+        targets = [torch.randint(0, 12, (n, 2)) for n in lengths]
+        # Like parse_spectra_song, the n - 1 beats between the frames, frame j starts at j
+        metadatas = [{'song': f'song{i} (+0)', 'beats': list(range(1, n))}
+                     for (i, n) in enumerate(lengths)]
+        chunks = ChunkedDataset(ListDataset(signals, targets, metadatas), 8, 2)
+
+        scored = [[] for _ in lengths]
+        for (signal, target, metadata) in chunks:
+            self.assertLessEqual(len(target), 8)
+            song = int(metadata['song'][4])
+            start = int(metadata['song'].split('[')[1].split(':')[0])
+            self.assertIn('(+0)', metadata['song'])
+            self.assertEqual(metadata['start_time'], start)
+            self.assertEqual(metadata['beats'], list(range(start + 1, start + len(target))))
+            self.assertTrue(torch.equal(signal, signals[song][start:start + len(target)]))
+
+            is_core = target[:, 0] != music_utils.CONTEXT
+            core = is_core.nonzero(as_tuple=True)[0]
+            # Cores are contiguous with full margins unless cut by the ends of the song
+            self.assertEqual(core.tolist(), list(range(core[0], core[-1] + 1)))
+            self.assertTrue(core[0] == 2 or start == 0)
+            self.assertTrue(core[-1] == len(target) - 3 or start + len(target) == lengths[song])
+            self.assertTrue(torch.equal(target[is_core], targets[song][start + core]))
+            scored[song] += (start + core).tolist()
+
+        # The cores tile every song exactly once
+        self.assertEqual(scored, [list(range(n)) for n in lengths])
+        self.assertEqual(chunks.lengths(), [len(target) for (_, target, _) in chunks])
+
+    def test_chunks_aligned(self):
+        props = self.data.props
+        song_lengths = [37, 12]
+        signals = [torch.rand(n, (props.octave_n + 2) * props.bin_n) for n in song_lengths]
+        # Chords change off the chunk boundaries
+        targets = [torch.tensor([((j // 3) % 12, 1) for j in range(n)]) for n in song_lengths]
+        metadatas = [{'song': f'song{i}', 'beats': [0.5 * j for j in range(1, n)]}
+                     for (i, n) in enumerate(song_lengths)]
+        songs = TransposedDataset(ListDataset(signals, targets, metadatas), [-1, 2], props)
+        chunks = ChunkedDataset(songs, 10, 2)
+
+        for (index, (signal, target, metadata)) in enumerate(chunks):
+            i, core_start, core_end = chunks.chunks[index]
+            song_signal, song_target, song_metadata = songs[i]
+            start = max(core_start - 2, 0)
+
+            self.assertEqual(len(signal), len(target))
+            self.assertEqual(len(metadata['beats']), len(target) - 1)
+            self.assertTrue(torch.equal(signal, song_signal[start:start + len(signal)]))
+            # Frame starts of the chunk are those of the same frames of the song
+            song_starts = [0.0] + song_metadata['beats']
+            self.assertEqual([metadata['start_time']] + metadata['beats'],
+                             song_starts[start:start + len(signal)])
+
+            is_core = target[:, 0] != music_utils.CONTEXT
+            self.assertTrue(torch.equal(target[is_core], song_target[core_start:core_end]))
+
+    def test_transposed_dataset_parity(self):
+        props = self.data.props
+        feature_n = (props.octave_n + 2) * props.bin_n
+        signals = [torch.rand(n, feature_n) for n in [4, 9]]
+        targets = [torch.stack([torch.randint(0, 12, (n, )), torch.randint(0, 6, (n, ))], 1)
+                   for n in [4, 9]]
+        targets[1][2, 0] = targets[1][2, 1] = music_utils.NO_ENCODING
+        metadatas = [{'song': 'a', 'annotations': [1, 2]}, {'song': 'b', 'annotations': []}]
+        dataset = ListDataset(signals, targets, metadatas)
+
+        shifts = range(-6, 6)
+        transposed = TransposedDataset(dataset, shifts, props)
+        self.assertEqual(len(transposed), 2 * len(shifts))
+        self.assertEqual(transposed.lengths(), [4, 9] * len(shifts))
+        for (i, (signal, target, metadata)) in enumerate(transposed):
+            song, shift = i % 2, shifts[i // 2]
+            start = props.bin_n + shift * props.bin_n // 12
+            self.assertTrue(torch.equal(signal, signals[song][:, start:start - 2 * props.bin_n]))
+
+            # Only the roots of chords move, N and unencoded beats keep theirs
+            original = targets[song]
+            is_chord = (original[:, 0] != music_utils.NO_ENCODING) & (original[:, 1] != 0)
+            self.assertTrue(torch.equal(target[:, 1], original[:, 1]))
+            self.assertTrue(torch.equal((target[is_chord, 0] + shift) % 12, original[is_chord, 0]))
+            self.assertTrue(torch.equal(target[~is_chord], original[~is_chord]))
+
+            self.assertEqual(metadata['song'], f'{metadatas[song]["song"]} ({shift:+})')
+            self.assertIs(metadata['annotations'], metadatas[song]['annotations'])
+
+        random.seed(0)
+        randomly = TransposedDataset(dataset, shifts, props, random_shift=True)
+        self.assertEqual(len(randomly), 2)
+        self.assertEqual(randomly.lengths(), [4, 9])
+        names = {randomly[0][2]['song'] for _ in range(20)}
+        self.assertGreater(len(names), 1)
+
+    def test_worker_loaders_parity(self):
+        with tempfile.TemporaryDirectory() as path:
+            writer = store_utils.FeatureStoreWriter(path)
+            for (i, n) in enumerate([5, 12, 7, 30, 9]):
+                writer.add(f'song{i}', {'chromas': list(np.random.rand(n, 6) + 0.1),
+                    'chords': [(j % 12, 1) for j in range(n)], 'beats': [],
+                    'annotations': [], 'annotation_mistiming': 0.0})
+            writer.close()
+
+            store = store_utils.FeatureStore(path)
+            self.data.train_data = self.data.store_dataset(store, store.select())
+            self.data.batch_size = 2
+            self.data.bucket_boundaries = [10]
+
+            batches = {}
+            for (workers, context) in [(0, None), (2, 'fork'), (2, 'spawn')]:
+                self.data.loader_workers = workers
+                self.data.loader_context = context
+                batches[context] = list(self.data.train_dataloader())
+
+            for context in ['fork', 'spawn']:
+                self.assertEqual(len(batches[None]), len(batches[context]))
+                for (serial, parallel) in zip(batches[None], batches[context]):
+                    self.assertTrue(torch.equal(serial[0], parallel[0]))
+                    self.assertTrue(torch.equal(serial[1], parallel[1]))
+                    self.assertEqual(serial[2], parallel[2])
+                    self.assertTrue(torch.equal(serial[3], parallel[3]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+
+import torch
+
+from chordnet.utils.metrics_utils import MetricsAccumulator
+
+import pdb
+
+class MetricsUtilsTest(unittest.TestCase):
+    def test_confusion(self):
+        metrics = MetricsAccumulator(4, 3)
+        expected = torch.zeros((4, 4), dtype=torch.long)
+        for _ in range(3):
+            true, pred = torch.randint(4, (50, )), torch.randint(4, (50, ))
+            metrics.add_confusion('root', true, pred)
+            for (t, p) in zip(true.tolist(), pred.tolist()):
+                expected[t, p] += 1
+
+        self.assertTrue(torch.equal(metrics.confusion('root'), expected))
+        self.assertTrue(torch.equal(metrics.confusion('quality'), torch.zeros((3, 3)).long()))
+
+    def test_means(self):
+        metrics = MetricsAccumulator(4, 3)
+        for value in [1.0, 2.0, 6.0]:
+            metrics.add_scalars({'loss': torch.tensor(value, requires_grad=True)})
+        means = metrics.means(['loss', 'root_acc'])
+        self.assertEqual(list(means.keys()), ['loss'])
+        self.assertAlmostEqual(means['loss'].item(), 3.0)
+        self.assertFalse(means['loss'].requires_grad)
+
+        metrics.reset()
+        self.assertEqual(metrics.step_n, 0)
+        self.assertEqual(metrics.means(['loss']), {})
+
+    def test_reservoir(self):
+        counts = [0] * 20
+        for seed in range(500):
+            metrics = MetricsAccumulator(4, 3, songs_n=3, seed=seed)
+            made = []
+            for song in range(20):
+                metrics.offer_song(lambda song=song: made.append(song) or song)
+            self.assertEqual(len(metrics.songs), 3)
+            self.assertEqual(len(set(metrics.songs)), 3)
+            # Only songs entering the reservoir are built
+            self.assertLess(len(made), 20)
+            for song in metrics.songs:
+                counts[song] += 1
+
+        # Every song is kept with probability 3 / 20
+        for count in counts:
+            self.assertAlmostEqual(count / 500, 3 / 20, delta=0.06)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import unittest
+import tempfile
+from unittest import mock
+
+import torch
+import torch.nn.functional as F
+import pytorch_lightning as pl
+from torch.utils.data import DataLoader
+from pytorch_lightning.loggers import TensorBoardLogger
+
+from chordnet.data import DataProperties, pad_collate
+from chordnet.models.mlp import MLP
+from chordnet.models.mlp_rnn import MLPRNN
+from chordnet.models.convnet import ConvNet
+from chordnet.models.chordnet import ChordNet
+from chordnet.utils import music_utils
+from chordnet.utils.music_utils import BillboardMajMin7Encoding
+
+import pdb
+
+def song_losses(model, signal, target):
+    root_pred, quality_pred, _ = model(signal)
+
+    has_encoding = (target[:, 0] != music_utils.NO_ENCODING).nonzero(as_tuple=True)[0]
+    root_pred, quality_pred = root_pred[has_encoding, :], quality_pred[has_encoding, :]
+    root_true, quality_true = target[has_encoding, 0], target[has_encoding, 1]
+
+    has_root = (quality_true != 0).nonzero(as_tuple=True)[0]
+    root_pred, root_true = root_pred[has_root, :], root_true[has_root]
+
+    accuracy = lambda pred, true: (torch.max(pred, 1)[1] == true).sum() / pred.shape[0]
+    if torch.numel(root_pred) > 0:
+        root_loss, root_acc = F.nll_loss(root_pred, root_true), accuracy(root_pred, root_true)
+    else:
+        root_loss, root_acc = torch.tensor(0.0), torch.tensor(1.0)
+
+    return root_loss, root_acc, F.nll_loss(quality_pred, quality_true), \
+        accuracy(quality_pred, quality_true)
+
+class ModelTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.data_props = DataProperties(BillboardMajMin7Encoding(), 5, 12)
+
+        songs = []
+        for (i, length) in enumerate([7, 15, 3, 12]):
+            signal = torch.rand(length, 5 * 12)
+            target = torch.stack((torch.randint(12, (length, )),
+                                  torch.randint(6, (length, ))), 1)
+            target[0] = torch.tensor([music_utils.NO_ENCODING, music_utils.NO_ENCODING])
+            if i == 2:
+                target[:, 1] = 0 # Only N chords, no root frames at all
+            songs.append((signal, target, {'beats': [0.5 * j for j in range(1, length)],
+                                           'song': f'{i} (+0)'}))
+        self.songs = songs
+
+    def check_losses(self, model):
+        model.eval()
+        batch = pad_collate(self.songs)
+        with torch.no_grad():
+            vars = model.compute_losses(batch, 'val_loss')
+            expected = [song_losses(model, signal, target) for (signal, target, _) in self.songs]
+
+        root_losses, root_accs, quality_losses, quality_accs = zip(*expected)
+        self.assertAlmostEqual(vars['root_loss'].item(), sum(root_losses).item(), places=4)
+        self.assertAlmostEqual(vars['quality_loss'].item(), sum(quality_losses).item(), places=4)
+        self.assertAlmostEqual(vars['root_acc'].item(),
+                               (sum(root_accs) / len(root_accs)).item(), places=5)
+        self.assertAlmostEqual(vars['quality_acc'].item(),
+                               (sum(quality_accs) / len(quality_accs)).item(), places=5)
+
+        metrics = model.epoch_metrics['Valid']
+        self.assertEqual([len(song['chords_pred']) for song in metrics.songs], [7, 15, 3, 12])
+        self.assertAlmostEqual(metrics.means(['loss'])['loss'].item(), vars['val_loss'].item())
+
+        # Confusions count every frame scored for the quality, and the root if there is one
+        targets = torch.cat([target for (_, target, _) in self.songs])
+        has_encoding = targets[:, 0] != music_utils.NO_ENCODING
+        self.assertEqual(metrics.confusion('quality').sum().item(), has_encoding.sum().item())
+        self.assertEqual(metrics.confusion('root').sum().item(),
+                         (has_encoding & (targets[:, 1] != 0)).sum().item())
+        self.assertEqual(metrics.confusion('quality').sum(1).tolist(),
+            torch.bincount(targets[has_encoding, 1], minlength=6).tolist())
+
+    def test_mlp(self):
+        self.check_losses(MLP(self.data_props))
+
+    def test_convnet(self):
+        self.check_losses(ConvNet(self.data_props))
+
+    def test_mlp_rnn(self):
+        self.check_losses(MLPRNN(self.data_props))
+
+    def test_chordnet(self):
+        self.check_losses(ChordNet(self.data_props))
+
+    def test_chordnet_fit(self):
+        model = ChordNet(self.data_props)
+        loader = DataLoader(self.songs, batch_size=2, collate_fn=pad_collate)
+        # Lightning before 1.6 rejects the schedulers of torch 2, the optimizer is enough here
+        optimizers, _ = model.configure_optimizers()
+        model.configure_optimizers = lambda: optimizers
+
+        with tempfile.TemporaryDirectory() as root, \
+             mock.patch.object(model, 'log_metrics', wraps=model.log_metrics) as log_metrics:
+            trainer = pl.Trainer(max_epochs=2, default_root_dir=root,
+                                 logger=TensorBoardLogger(root), enable_checkpointing=False,
+                                 enable_progress_bar=False, enable_model_summary=False)
+            trainer.fit(model, loader, loader)
+
+        # Both epochs were summarized, the last one over all training songs
+        stages = [call.args[1] for call in log_metrics.call_args_list]
+        self.assertEqual(stages.count('Train'), 2)
+        self.assertEqual(model.epoch_metrics['Train'].step_n, len(loader))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+import pickle
+
+import pychord
+
+from chordnet.utils import music_utils
+from chordnet.utils.music_utils import Chord
+
+import pdb
+
+ENCODINGS = [music_utils.GeneratedEncoding(), music_utils.BillboardMajMinEncoding(),
+             music_utils.BillboardMajMin7Encoding()]
+
+def parsed_notes(chord, encoding):
+    if chord.root == music_utils.NO_ENCODING or encoding.int_to_quality(chord.quality) == 'N':
+        return []
+
+    string = Chord.to_pychord_string(encoding.int_to_note(chord.root) +
+                                     encoding.int_to_quality(chord.quality))
+    return [n + 3 for n in pychord.Chord(string).components(visible=False)]
+
+class MusicUtilsTest(unittest.TestCase):
+    def test_lookup_parity(self):
+        for encoding in ENCODINGS:
+            for root in range(encoding.root_n()):
+                for quality in range(encoding.quality_n()):
+                    chord = Chord(root, quality)
+                    string = chord.string_encoding(encoding)
+                    self.assertEqual(encoding.string_to_chord(string),
+                                     Chord.parse_string(string, encoding))
+                    self.assertEqual(chord.notes(encoding), parsed_notes(chord, encoding))
+
+                    mask = encoding.note_masks[root, quality]
+                    self.assertEqual([note for note in range(12) if (mask >> note) & 1],
+                                     sorted({note % 12 for note in chord.notes(encoding)}))
+
+    def test_unencoded(self):
+        encoding = music_utils.BillboardMajMin7Encoding()
+        self.assertEqual(encoding.string_to_chord('X'), Chord.create_no_encoding().to_tuple())
+        self.assertEqual(encoding.string_to_chord('N'), (0, 0))
+        self.assertEqual(encoding.chord_string(music_utils.NO_ENCODING, 0), 'X')
+        self.assertEqual(encoding.chord_string(music_utils.CONTEXT, 0), 'X')
+        self.assertEqual(Chord.create_no_encoding().notes(encoding), [])
+
+    def test_memoized_spellings(self):
+        encoding = music_utils.BillboardMajMin7Encoding()
+        for string in ['A#maj', 'Cbmin7', 'G#7']:
+            chord = encoding.string_to_chord(string)
+            self.assertEqual(chord, Chord.parse_string(string, encoding))
+            self.assertIs(encoding.string_to_chord(string), chord)
+
+    def test_pickle(self):
+        encoding = pickle.loads(pickle.dumps(music_utils.BillboardMajMinEncoding()))
+        self.assertEqual(encoding.string_to_chord('Ebmin'), (6, 2))
+        self.assertEqual(encoding.chord_string(6, 2), 'Ebmin')
+
+if __name__ == '__main__':
+    unittest.main()
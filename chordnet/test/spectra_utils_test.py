@@ -0,0 +1,96 @@
+import unittest
+
+import numpy as np
+
+from chordnet.utils import spectra_utils
+
+import pdb
+
+def loop_binning(PofT, samps, f0, octaves, bin_n):
+    A = 440
+    Z = bin_n // 12
+
+    subtonesofToct = np.zeros((len(octaves), 12 * Z, PofT.shape[1]))
+
+    for i, octv in enumerate(octaves):
+        notes = A*2**octv*np.power(2**(1/12), np.arange(0,12+1,1))
+        subtones = A*2**octv*np.power(2**(1/12), np.arange(1/(2*Z), 12 + 1/(2*Z), 1/Z))
+        note_is = (notes*(2*samps/f0)).astype(int)
+        subtone_is = (subtones*(2*samps/f0)).astype(int)
+
+        low_i = note_is[0]
+        high_i = note_is[-1]
+
+        for j in range(12 * Z):
+            if j == 0:
+                notepow = np.vstack((PofT[low_i:subtone_is[0],:], PofT[subtone_is[-1]:high_i, :]))
+            else:
+                notepow = PofT[subtone_is[j-1]:subtone_is[j]]
+
+            len_notepow, _ = np.shape(notepow)
+
+            if len_notepow != 0:
+                subtonesofToct[i, j, :] += np.sum(notepow, axis = 0)/len_notepow
+
+    return subtonesofToct
+
+class SpectraUtilsTest(unittest.TestCase):
+    def check_parity(self, samps, f0, octaves, bin_n):
+        PofT = np.random.rand(samps, 1) ** 2
+
+        expected = loop_binning(PofT, samps, f0, octaves, bin_n)
+
+        binning = spectra_utils.bin_matrix(samps, f0, tuple(octaves), bin_n)
+        actual = (binning @ PofT).reshape(len(octaves), bin_n, 1)
+
+        np.testing.assert_allclose(actual, expected, rtol=1e-10, atol=1e-12)
+
+    def test_bin_matrix_parity(self):
+        octaves = list(range(-5, 4))
+        for bin_n in [12, 24, 36]:
+            for samps in [4410, 22050, 30001, 88200]:
+                self.check_parity(samps, 44100, octaves, bin_n)
+
+    def test_bin_matrix_parity_short_window(self):
+        # Short windows leave many subtone bins empty and clip the highest octaves
+        self.check_parity(200, 44100, list(range(-5, 4)), 24)
+        self.check_parity(2000, 22050, list(range(-2, 7)), 24)
+
+    def test_bin_matrix_cached(self):
+        a = spectra_utils.bin_matrix(1000, 44100, (-1, 0), 24)
+        b = spectra_utils.bin_matrix(1000, 44100, (-1, 0), 24)
+        self.assertIs(a, b)
+
+    def test_window_length(self):
+        for samps in np.random.randint(4000, 200000, 500):
+            length = spectra_utils.window_length(samps)
+            self.assertLessEqual(length, samps)
+            self.assertGreaterEqual(length, 0.94 * samps)
+
+            for factor in [2, 3, 5]:
+                while length % factor == 0:
+                    length //= factor
+            self.assertEqual(length, 1)
+
+    def test_cqt_spectrogram(self):
+        f0, hop, octaves, bin_n = 22050, 512, (-2, -1, 0, 1), 24
+        t = np.arange(2 * f0) / f0
+        power, frame_times = spectra_utils.cqt_spectrogram(np.sin(2 * np.pi * 440 * t), f0,
+                                                           octaves, bin_n, hop=hop)
+
+        self.assertEqual(power.shape, (1 + len(t) // hop, len(octaves) * bin_n))
+        np.testing.assert_allclose(frame_times, np.arange(len(power)) * hop / f0)
+        # A440 is the first bin of octave 0
+        self.assertEqual(np.argmax(power[len(power) // 2]), octaves.index(0) * bin_n)
+
+    def test_pool_frames(self):
+        frames = np.arange(10, dtype=float).reshape(10, 1)
+        frame_times = np.arange(10) * 0.1
+
+        pooled = spectra_utils.pool_frames(frames, frame_times, [0.0, 0.25, 0.28, 1.0])
+
+        # Second interval contains no frame and falls back to the frame at 0.3
+        np.testing.assert_allclose(pooled.flatten(), [1.0, 3.0, 6.0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+import tempfile
+import pickle
+
+import numpy as np
+import torch
+
+from chordnet.utils import store_utils
+
+import pdb
+
+class StoreUtilsTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+
+        writer = store_utils.FeatureStoreWriter(self.root.name, encoding='TestEncoding')
+        self.songs = [('intro-drums', 4, 0.1), ('verse', 6, 0.7), ('chorus-drums', 3, 0.3),
+                      ('bridge', 5, 0.2)]
+        for (song, beat_n, mistiming) in self.songs:
+            writer.add(song, {'chromas': list(np.random.rand(beat_n, 3) + 0.1),
+                              'chords': [(0, 1)] * beat_n, 'beats': list(range(1, beat_n)),
+                              'annotations': [((0, 1), 0.0, 1.0)],
+                              'annotation_mistiming': mistiming, 'duration': 2.0 * beat_n})
+        writer.close()
+        self.store = store_utils.FeatureStore(self.root.name)
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def test_select(self):
+        self.assertTrue(store_utils.FeatureStore.exists(self.root.name))
+        self.assertEqual(len(self.store), 4)
+        self.assertEqual(self.store.select(), [0, 1, 2, 3])
+        self.assertEqual(self.store.select('-drums'), [0, 2])
+        self.assertEqual(self.store.select(max_mistiming=0.5), [0, 2, 3])
+        self.assertEqual(self.store.select('-drums', 0.2), [0])
+
+    def test_metadatas(self):
+        metadatas = self.store.metadatas([3, 1])
+        self.assertEqual([metadata['song'] for metadata in metadatas], ['bridge', 'verse'])
+        self.assertEqual(metadatas[0]['beats'], [1, 2, 3, 4])
+        self.assertEqual(metadatas[1]['annotations'], [((0, 1), 0.0, 1.0)])
+        self.assertAlmostEqual(metadatas[1]['annotation_mistiming'], 0.7)
+
+        # Manifest locations match the song views
+        for (id, start) in self.store.query('SELECT id, start FROM songs'):
+            self.assertEqual(start, self.store.offsets[id])
+            self.assertEqual(len(self.store.signal(id)), self.songs[id][1])
+        self.assertEqual(self.store.lengths([3, 1]), [5, 6])
+
+    def test_stats(self):
+        self.assertEqual(self.store.stats(), {'song_n': 4, 'beat_n': 18, 'duration': 36.0})
+        self.assertEqual(self.store.stats([0, 2]), {'song_n': 2, 'beat_n': 7, 'duration': 14.0})
+        self.assertEqual(self.store.stats([]), {'song_n': 0, 'beat_n': 0, 'duration': 0.0})
+        self.assertEqual(self.store.query('SELECT DISTINCT encoding FROM songs'),
+                         [('TestEncoding', )])
+
+    def test_pickle(self):
+        self.store.signal(0)
+        store = pickle.loads(pickle.dumps(self.store))
+        self.assertIsNone(store.arrays)
+        self.assertTrue(torch.equal(store.signals([3, 1])[1], self.store.signal(1)))
+        self.assertTrue(torch.equal(store.target(2), self.store.target(2)))
+
+    def test_interrupted_writer(self):
+        with tempfile.TemporaryDirectory() as path:
+            writer = store_utils.FeatureStoreWriter(path)
+            writer.add('verse', {'chromas': list(np.random.rand(3, 3)), 'chords': [(0, 1)] * 3,
+                                 'beats': [1, 2], 'annotations': [], 'annotation_mistiming': 0.0})
+            # Never closed, like a fetch cut short
+            self.assertFalse(store_utils.FeatureStore.exists(path))
+            writer.close()
+            self.assertTrue(store_utils.FeatureStore.exists(path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+import random
+from unittest import mock
+
+import numpy as np
+import torch
+
+from chordnet.data import ChordDataModule
+from chordnet.models.chordnet import ChordNet
+from chordnet.stream import StreamingChordRecognizer, stream_song
+from chordnet.utils.audio_utils import Audio
+from chordnet.utils.data_utils import DatasetType
+from chordnet.utils.music_utils import Chord
+
+import pdb
+
+class StreamTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.data = ChordDataModule(DatasetType.BILLBOARD_MAJMIN7_ALL, True)
+        self.model = ChordNet(self.data.props)
+
+    def test_windowed_parity(self):
+        self.check_parity(incremental=False)
+
+    def test_incremental_parity(self):
+        self.check_parity(incremental=True)
+
+    def check_parity(self, incremental):
+        recognizer = StreamingChordRecognizer(self.model, self.data)
+        recognizer.incremental = incremental
+        bin_n = self.data.props.bin_n
+        spectra = np.random.rand(17, (self.data.props.octave_n + 2) * bin_n)
+        # The first beat holds the song maximum, so the running maximum matches offline
+        spectra[0, 0] = 2.0
+
+        chords = []
+        for (i, spectrum) in enumerate(spectra):
+            recognizer.push_spectrum(i, i + 1, spectrum)
+            chords += recognizer.emit(0.0, flushing=False)
+            self.assertEqual(len(chords), max(i + 1 - recognizer.lookahead, 0))
+        chords += recognizer.emit(0.0, flushing=True)
+
+        signal = torch.from_numpy(spectra / spectra.max()).type(torch.FloatTensor)
+        with torch.no_grad():
+            roots, qualities, _ = self.model(signal[:, bin_n:-bin_n])
+        expected = [Chord(root.item(), quality.item()).string_encoding(self.data.props.encoding)
+                    for (root, quality) in zip(roots.argmax(1), qualities.argmax(1))]
+
+        self.assertEqual([chord.chord for chord in chords], expected)
+        self.assertEqual([(chord.start, chord.end) for chord in chords],
+                         [(i, i + 1) for i in range(len(spectra))])
+        self.assertLessEqual(len(recognizer.spectra),
+                             recognizer.history + recognizer.lookahead + 1)
+
+    def test_block_size_invariance(self):
+        song = 'misc/samples/cmajprog.wav'
+        chords = stream_song(StreamingChordRecognizer(self.model, self.data), song, 1024)
+        chords_other = stream_song(StreamingChordRecognizer(self.model, self.data), song, 3000)
+
+        self.assertGreater(len(chords), 0)
+        self.assertEqual(chords[-1].end, chords_other[-1].end)
+        self.assertEqual([(c.start, c.end, c.chord) for c in chords],
+                         [(c.start, c.end, c.chord) for c in chords_other])
+        self.assertTrue(all(chord.latency >= 0 for chord in chords))
+
+    def test_offline_spectra_parity(self):
+        song = 'misc/samples/cmajprog.wav'
+        recognizer = StreamingChordRecognizer(self.model, self.data, seed=0)
+        with mock.patch.object(recognizer, 'push_spectrum') as push_spectrum:
+            stream_song(recognizer, song, 1024)
+        streamed = [call.args for call in push_spectrum.call_args_list]
+        self.assertGreater(len(streamed), 1)
+
+        # Same beats, audio scale and subwindow draws over the whole song
+        audio = Audio.read(song)
+        beats = [streamed[0][0]] + [end for (_, end, _) in streamed]
+        offline = self.data.parse_spectra_beats(audio.normalized() * recognizer.PCM_SCALE,
+            audio.sample_rate, recognizer.octaves, beats, rng=random.Random(0))
+
+        np.testing.assert_allclose(np.stack([spectrum for (_, _, spectrum) in streamed]),
+                                   offline.reshape(len(streamed), -1), rtol=1e-5, atol=1e-8)
+
+    def test_cqt_rejected(self):
+        # Spectra of single beats are too far off the pooled spectrogram of the whole song
+        data = ChordDataModule(DatasetType.BILLBOARD_MAJMIN7_ALL, True, extractor='cqt')
+        with self.assertRaises(ValueError):
+            StreamingChordRecognizer(self.model, data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import unittest
+import threading
+
+import numpy as np
+from madmom.audio.signal import Signal
+
+from chordnet.utils import tempo
+from chordnet.utils.tempo import TempoDetector
+from chordnet.utils.audio_utils import Audio
+
+import pdb
+
+def loop_peak_picking(beat_times, n_t_medians, beat_samples, offset=0.01):
+    peaks = []
+    for i in range(len(beat_times) - 1):
+        if beat_times[i] > 0:
+            if beat_times[i] > beat_times[i - 1]:
+                if beat_times[i] > beat_times[i + 1]:
+                    if beat_times[i] > (n_t_medians[i] + offset):
+                        peaks.append(int(beat_samples[i]))
+    return peaks
+
+def click_track(bpm, fs, duration, offset):
+    y = np.zeros(fs * duration)
+    beats = np.arange(offset, duration, 60 / bpm)
+    for beat in beats:
+        start = int(beat * fs)
+        y[start:start + 200] += 8000 * np.random.randn(200)
+    return y, beats
+
+class TempoTest(unittest.TestCase):
+    def detect(self, path):
+        detector = TempoDetector()
+        detector.uploadSong(path)
+        return detector.detectBPM('RNN')
+
+    def test_beat_tracker_per_thread(self):
+        tracker = tempo.beat_tracker(**TempoDetector.RNN_CONFIG)
+        self.assertIs(tracker, tempo.beat_tracker(**TempoDetector.RNN_CONFIG))
+
+        other = []
+        thread = threading.Thread(
+            target=lambda: other.append(tempo.beat_tracker(**TempoDetector.RNN_CONFIG)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(tracker, other[0])
+
+    def test_reused_tracker_parity(self):
+        path = 'misc/samples/cmajprog.wav'
+        bpm, beats = self.detect(path)
+        self.detect('misc/samples/Amaj-drums.wav')
+        bpm_again, beats_again = self.detect(path)
+
+        self.assertEqual(bpm, bpm_again)
+        np.testing.assert_array_equal(beats, beats_again)
+
+        audio = Audio.read(path)
+        fresh = tempo.BeatTracker(**TempoDetector.RNN_CONFIG)
+        # detectBPM only tracks whole seconds of audio
+        samples = audio.normalized()[:int(audio.duration()) * audio.sample_rate]
+        fresh_bpm, fresh_beats = fresh.track(Signal(samples, sample_rate=audio.sample_rate))
+        self.assertEqual(bpm, fresh_bpm)
+        np.testing.assert_allclose(beats, fresh_beats)
+
+    def test_autocorrelation_parity(self):
+        x = np.random.randn(5001)
+        expected = np.correlate(x, x, 'full')[len(x) - 1:]
+        np.testing.assert_allclose(TempoDetector().autocorrelation(x), expected, atol=1e-8)
+
+    def test_peak_picking_parity(self):
+        from scipy import signal
+
+        detector = TempoDetector()
+        for _ in range(10):
+            beat_times = np.random.rand(400) - 0.3
+            total_samples = 100000
+
+            # Reproduce the smoothing peakPicking applies before detecting peaks
+            b, a = signal.butter(1, len(beat_times) / total_samples * 100 / 2)
+            smoothed = signal.filtfilt(b, a, beat_times)
+            beat_samples = np.linspace(0, total_samples, len(beat_times), endpoint=True, dtype=int)
+            expected = loop_peak_picking(smoothed, signal.medfilt(smoothed, kernel_size=5),
+                                         beat_samples)
+
+            self.assertEqual(detector.peakPicking(beat_times, total_samples, 5, 0), expected)
+
+    def test_signal_processing_click_track(self):
+        np.random.seed(0)
+        fs = 22050
+        for bpm in [60, 95, 140]:
+            y, beats = click_track(bpm, fs, 12, offset=0.4)
+            detected_bpm, detected_beats = TempoDetector().detectBPM_SignalProcessing(y, fs)
+
+            self.assertAlmostEqual(detected_bpm, bpm, delta=1)
+            np.testing.assert_allclose(detected_beats[:len(beats) // 2],
+                                       beats[:len(beats) // 2], atol=0.02)
+
+    def test_signal_processing_silence(self):
+        self.assertEqual(TempoDetector().detectBPM_SignalProcessing(np.zeros(22050 * 5), 22050),
+                         (None, None))
+
+    def stream(self, tracker, samples, block_sizes):
+        beats, start = [], 0
+        for block_size in block_sizes:
+            beats.append(tracker.process(samples[start:start + block_size]))
+            self.assertLess(len(tracker.pending), tracker.hop_size)
+            start += block_size
+        return np.concatenate(beats)
+
+    def test_streaming_block_size_invariance(self):
+        audio = Audio.read('misc/samples/Amaj-drums.wav')
+        samples = audio.normalized()[:audio.sample_rate * 4]
+        tracker = tempo.StreamingBeatTracker(sample_rate=audio.sample_rate)
+
+        beats = self.stream(tracker, samples, [1024] * (len(samples) // 1024 + 1))
+        self.assertGreater(len(beats), 0)
+        self.assertTrue(np.all(beats <= len(samples) / audio.sample_rate))
+
+        tracker.reset()
+        splits = np.sort(np.random.RandomState(0).randint(0, len(samples), size=100))
+        block_sizes = np.diff(np.concatenate(([0], splits, [len(samples)])))
+        np.testing.assert_array_equal(self.stream(tracker, samples, block_sizes), beats)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -52,14 +52,53 @@ data_choices = ['gen', 'bill-mm-tiny', 'bill-mm7-tiny',
 @click.option('--file_filter', default='') # Can be something like -drums for generated
 
 @click.option('--augment/--no_augment', default=False)
-
-def run(model, epochs, data, fetch_data, file_filter, augment):
+@click.option('--random_shift/--all_shifts', default=False,
+              help='Augment with one random transposition per song and epoch instead of all 12.')
+
+@click.option('--extractor', default=None, type=click.Choice(ChordDataModule.EXTRACTORS),
+              help='Spectral feature extractor used when fetching data, dct by default. Without a '
+                   'fetch it must match the stored features and defaults to their extractor.')
+
+@click.option('--workers', default=1, help='Processes used to parse spectra when fetching data.')
+
+@click.option('--batch_size', default=1, help='Songs per training batch.')
+
+@click.option('--buckets', default=None,
+              help='Comma separated beat counts separating the length buckets of training '
+                   'batches, e.g. 200,400. Defaults to ChordDataModule.BUCKET_BOUNDARIES.')
+
+@click.option('--chunk_len', default=0,
+              help='Train on overlapping chunks of this many beats instead of whole songs, '
+                   '0 trains on whole songs.')
+
+@click.option('--loader_workers', default=0, help='DataLoader worker processes.')
+@click.option('--persistent_workers/--no_persistent_workers', default=True,
+              help='Keep DataLoader workers alive between epochs.')
+@click.option('--prefetch_factor', default=2, help='Batches loaded ahead by every worker.')
+@click.option('--pin_memory/--no_pin_memory', default=False,
+              help='Page-lock batches for faster copies to the GPU.')
+@click.option('--loader_context', default=None,
+              type=click.Choice(['fork', 'spawn', 'forkserver']),
+              help='Start method of DataLoader workers, defaults to the platform default.')
+
+def run(model, epochs, data, fetch_data, file_filter, augment, random_shift, extractor, workers,
+        batch_size, buckets, chunk_len, loader_workers, persistent_workers, prefetch_factor,
+        pin_memory, loader_context):
     if data is not None and fetch_data and not click.confirm('Overwrite data with fetch?'):
         return
 
+    bucket_boundaries = None
+    if buckets is not None:
+        bucket_boundaries = [int(boundary) for boundary in buckets.split(',') if boundary]
+
     dataset = ChordDataModule(DatasetType.from_string(data), fetch_data,
-                              file_filter=file_filter, augment=augment,
-                              batch_size=1, split=[0.5, 0.5, 0.0])
+                              file_filter=file_filter, augment=augment, random_shift=random_shift,
+                              batch_size=batch_size, split=[0.5, 0.5, 0.0], extractor=extractor,
+                              workers=workers, bucket_boundaries=bucket_boundaries,
+                              chunk_len=chunk_len, loader_workers=loader_workers,
+                              persistent_workers=persistent_workers,
+                              prefetch_factor=prefetch_factor, pin_memory=pin_memory,
+                              loader_context=loader_context)
 
     # Tuples of network, gpus
     models = {'mlp': (MLP(dataset.props), 0),
@@ -1,10 +1,13 @@
 import operator
+import zipfile
+import numpy as np
 
 from chordnet.utils.data_utils import DatasetType
 from chordnet.utils import dirs
 from chordnet.utils.music_utils import *
 
-def load_annotations(song_id, dataset_type, chord_encoding):
+def annotations_member(song_id, dataset_type):
+    """Path of a song's annotations relative to the data directory / inside the dataset zip."""
     lab_files = {
         DatasetType.BILLBOARD_MAJMIN_TINY:    'majmin.lab',
         DatasetType.BILLBOARD_MAJMIN7_TINY:   'majmin7.lab',
@@ -14,28 +17,41 @@ def load_annotations(song_id, dataset_type, chord_encoding):
         DatasetType.BILLBOARD_MAJMIN7_ALL:    'majmin7.lab'
     }
 
-    annotations_file = dirs.data_path(
-        'annotations-mirex', song_id, lab_files[dataset_type])
+    return '/'.join(['annotations-mirex', song_id, lab_files[dataset_type]])
 
-    with open(annotations_file, 'r') as f:
-        annotation_lines = f.read().splitlines();
-        annotations = []
-        for line in annotation_lines:
-            if len(line) == 0:
-                continue
+def read_annotations_file(song_id, dataset_type, archive=None):
+    """Raw annotation text, from the dataset zip archive if given, else the data directory."""
+    member = annotations_member(song_id, dataset_type)
 
-            parts = line.split('\t')
+    if archive is not None:
+        with zipfile.ZipFile(archive, 'r') as zip_ref:
+            return zip_ref.read(member).decode()
 
-            chord_string = parts[2]
-            if chord_string == 'N':
-                chord = Chord.create_no_chord(chord_encoding)
-            elif chord_string == 'X':
-                chord = Chord.create_no_encoding()
-            else:
-                chord_string = standardize_chord(chord_string).replace(':', '')
-                chord = Chord.create_from_string(chord_string, chord_encoding)
+    with open(dirs.data_path(*member.split('/')), 'r') as f:
+        return f.read()
 
-            annotations.append((chord.to_tuple(), float(parts[0]), float(parts[1])))
+def load_annotations(song_id, dataset_type, chord_encoding, archive=None):
+    return parse_annotations(read_annotations_file(song_id, dataset_type, archive), chord_encoding)
+
+def parse_annotations(annotations_text, chord_encoding):
+    annotation_lines = annotations_text.splitlines();
+    annotations = []
+    for line in annotation_lines:
+        if len(line) == 0:
+            continue
+
+        parts = line.split('\t')
+
+        chord_string = parts[2]
+        if chord_string == 'N':
+            chord = Chord.create_no_chord(chord_encoding)
+        elif chord_string == 'X':
+            chord = Chord.create_no_encoding()
+        else:
+            chord_string = standardize_chord(chord_string).replace(':', '')
+            chord = Chord.create_from_string(chord_string, chord_encoding)
+
+        annotations.append((chord.to_tuple(), float(parts[0]), float(parts[1])))
 
     return annotations
 
@@ -66,5 +82,62 @@ def best_match(annotations, start_time, end_time):
     # Return the annotation with the maximum overlap
     return max(candidates.items(), key=operator.itemgetter(1))[0]
 
+def best_matches(annotations, beats):
+    """The best_match chords of all intervals between consecutive beats, in one sweep.
+
+    Annotations are indexed by start time, with the running maximum of their end times, so the
+    annotations overlapping a beat are a contiguous range found by binary search. The overlaps
+    of each beat are summed per chord, ties and beats without overlap resolve like best_match.
+
+    Parameters:
+        annotations: list of (chord, start, end) annotations.
+        beats: increasing beat times.
+
+    Returns:
+        A list of len(beats) - 1 chords.
+    """
+    beats = np.asarray(beats, dtype=np.float64)
+    if len(beats) < 2:
+        return []
+
+    # Chords are numbered by first appearance, which best_match breaks ties by
+    chord_ids = {}
+    for annotation in annotations:
+        chord_ids.setdefault(annotation[0], len(chord_ids))
+    chords = list(chord_ids.keys())
+
+    order = np.argsort([annotation[1] for annotation in annotations], kind='stable')
+    starts = np.array([annotations[i][1] for i in order], dtype=np.float64)
+    ends = np.array([annotations[i][2] for i in order], dtype=np.float64)
+    ids = np.array([chord_ids[annotations[i][0]] for i in order], dtype=np.int64)
+
+    # Annotations before first end before the beat starts, annotations from last on start
+    # after it ends
+    beat_starts, beat_ends = beats[:-1], beats[1:]
+    first = np.searchsorted(np.maximum.accumulate(ends), beat_starts, side='right')
+    last = np.searchsorted(starts, beat_ends, side='left')
+    counts = np.maximum(last - first, 0)
+
+    beat_is = np.repeat(np.arange(len(beat_starts)), counts)
+    annotation_is = np.repeat(first, counts) + \
+                    (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+
+    overlaps = np.minimum(beat_ends[beat_is], ends[annotation_is]) - \
+               np.maximum(beat_starts[beat_is], starts[annotation_is])
+    totals = np.zeros((len(beat_starts), len(chords)))
+    np.add.at(totals, (beat_is, ids[annotation_is]), np.maximum(overlaps, 0))
+
+    return [chords[i] for i in np.argmax(totals, axis=1)]
+
+def nearest_distances(times, beats):
+    """Distance from each of the times to its nearest beat."""
+    beats = np.sort(np.asarray(beats, dtype=np.float64))
+    times = np.asarray(times, dtype=np.float64)
+
+    after = np.searchsorted(beats, times)
+    before = np.clip(after - 1, 0, len(beats) - 1)
+    after = np.clip(after, 0, len(beats) - 1)
+    return np.minimum(np.abs(times - beats[before]), np.abs(beats[after] - times))
+
 def interval_overlap(a, b):
     return max(0, min(a[1], b[1]) - max(a[0], b[0]))
@@ -0,0 +1,66 @@
+import io
+import numpy as np
+from scipy.io import wavfile as wav
+
+from dataclasses import dataclass
+from typing import Union, BinaryIO
+
+
+@dataclass
+class Audio():
+    """Decoded audio, shared between tempo detection and spectral feature extraction.
+
+    samples: mono float32 samples, the sum of all channels at the PCM scale of the source
+        (e.g. in int16 units). Memory-mapped when read with mmap from a mono float32 file.
+    sample_rate: sampling frequency in Hz.
+    full_scale: magnitude of a full scale sample of one channel in the source.
+    channel_n: number of channels summed into samples.
+    name: file name of the source.
+    """
+    samples: np.ndarray
+    sample_rate: int
+    full_scale: float
+    channel_n: int
+    name: str = ''
+
+    @staticmethod
+    def read(source: Union[str, BinaryIO, bytes], name: str = '', mmap: bool = False) -> 'Audio':
+        """Decodes a wav file once.
+
+        Arguments:
+            source: file path, file-like object or the wav bytes.
+            name: name of the audio, defaults to the source path.
+            mmap: memory-map the decoded samples instead of reading them into memory (only for
+                file paths). Channels still need to be mixed for stereo or integer sources.
+        """
+        if isinstance(source, bytes):
+            source = io.BytesIO(source)
+        if isinstance(source, str):
+            name = name or source
+        else:
+            mmap = False
+
+        sample_rate, data = wav.read(source, mmap=mmap)
+
+        if np.issubdtype(data.dtype, np.integer):
+            full_scale = float(np.iinfo(data.dtype).max)
+        else:
+            full_scale = 1.0
+
+        channel_n = 1 if len(data.shape) == 1 else data.shape[1]
+        if channel_n == 1 and data.dtype == np.float32:
+            samples = data.reshape(-1)
+        elif channel_n == 1:
+            samples = data.reshape(-1).astype(np.float32)
+        else:
+            samples = data.sum(axis=1, dtype=np.float32)
+
+        return Audio(samples, sample_rate, full_scale, channel_n, name)
+
+    def duration(self) -> float:
+        """Length in seconds."""
+        return len(self.samples) / self.sample_rate
+
+    def normalized(self) -> np.ndarray:
+        """Mean of the channels scaled to [-1, 1]."""
+        return (self.samples / (self.full_scale * self.channel_n)).astype(np.float32)
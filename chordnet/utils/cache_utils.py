@@ -0,0 +1,92 @@
+import hashlib
+import os
+import pickle
+
+from typing import Any, Dict, Optional
+
+from chordnet.utils import dirs, file_utils
+
+
+def hash_file(path: str) -> str:
+    """Hex digest of the contents of a file."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_bytes(data: bytes) -> str:
+    """Hex digest of some bytes, e.g. a wav read into memory."""
+    return hashlib.sha1(data).hexdigest()
+
+
+def hash_params(*params: Any) -> str:
+    """Hex digest of the repr of some parameters, e.g. extractor settings."""
+    return hashlib.sha1(repr(params).encode()).hexdigest()
+
+
+class FeatureCache():
+    def __init__(self, root: str = dirs.cache_path(), size_limits: Optional[Dict[str, int]] = None):
+        """Persistent content-addressed cache of parsed song features.
+
+        Entries are grouped by kind (e.g. 'beats', 'chromas', 'annotations') and stored as
+        pickles under root/kind/key.pickle. Writes are atomic, so concurrent workers can share
+        the cache and an interrupted fetch never leaves a partial entry behind.
+
+        Kinds with a size limit are kept under it by evicting the least recently used entries
+        on put. Reads refresh an entry's modification time, which serves as its last use.
+
+        Arguments:
+            root: the cache directory.
+            size_limits: maximum total bytes of the entries of some kinds, e.g. {'beats': 1 << 26}.
+        """
+        self.root = root
+        self.size_limits = size_limits or {}
+
+    def path(self, kind: str, key: str) -> str:
+        return os.path.join(self.root, kind, key + '.pickle')
+
+    def get(self, kind: str, key: str) -> Optional[Any]:
+        """The cached value, or None if there is no entry."""
+        try:
+            with open(self.path(kind, key), 'rb') as file:
+                value = pickle.load(file)
+        except FileNotFoundError:
+            return None
+
+        if kind in self.size_limits:
+            try:
+                os.utime(self.path(kind, key))
+            except FileNotFoundError: # Evicted by another worker meanwhile
+                pass
+        return value
+
+    def put(self, kind: str, key: str, value: Any) -> None:
+        file_utils.ensure_created_directory(os.path.join(self.root, kind))
+        file_utils.write_pickle_atomic(self.path(kind, key), value)
+        if kind in self.size_limits:
+            self.evict(kind, self.size_limits[kind])
+
+    def evict(self, kind: str, max_bytes: int) -> None:
+        """Removes the least recently used entries of a kind until they fit in max_bytes."""
+        entries = []
+        with os.scandir(os.path.join(self.root, kind)) as scan:
+            for entry in scan:
+                if not entry.name.endswith('.pickle'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, path) in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -15,3 +15,7 @@ def data_path(*path: str) -> str:
 LIB_DIR = root_path('lib')
 def lib_path(*path: str) -> str:
     return op.join(LIB_DIR, *path)
+
+CACHE_DIR = root_path('cache')
+def cache_path(*path: str) -> str:
+    return op.join(CACHE_DIR, *path)
@@ -16,7 +16,7 @@ from chordnet.utils import dirs
 
 def files_with_extension(directory: str, extension: str) -> List[str]:
     """A list of files in a directory with the given extension."""
-    files = os.listdir(dirs.data_path())
+    files = os.listdir(directory)
     files = [f for f in files if f.endswith(extension)]
     return files
 
@@ -64,8 +64,7 @@ def create_empty_directory(path: str) -> None:
 
 def ensure_created_directory(path: str) -> None:
     """If directory does not exist, create it."""
-    if not os.path.exists(path):
-        os.makedirs(path)
+    os.makedirs(path, exist_ok=True)
 
 
 def read_file(path: str) -> str:
@@ -81,6 +80,14 @@ def write_file(path: str, data: str) -> None:
         file.write(data)
 
 
+def write_pickle_atomic(path: str, data: Any) -> None:
+    """Pickle data to path, so that readers only ever see a missing or complete file."""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        pickle.dump(data, file)
+    os.replace(tmp_path, path)
+
+
 def listify_tensors(params: Any) -> Any:
     """Iterate over an object dictionary, turning any tensors into list representations."""
     for field in params.__dict__:
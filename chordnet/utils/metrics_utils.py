@@ -0,0 +1,72 @@
+import random
+import torch
+
+from typing import Any, Callable, Dict, List
+
+
+class MetricsAccumulator():
+    def __init__(self, root_n: int, quality_n: int, songs_n: int = 5, seed: int = 0):
+        """Accumulates the metrics of an epoch step by step, without retaining step outputs.
+
+        Scalars are summed for their means over steps, confusion matrices are counted on the
+        device of the predictions, and a reservoir sample of songs_n songs is kept for the
+        figures. Every offered song is equally likely to be in the sample.
+
+        Arguments:
+            root_n: number of root classes.
+            quality_n: number of quality classes.
+            songs_n: size of the song reservoir.
+            seed: seeds the reservoir sampling.
+        """
+        self.class_ns = {'root': root_n, 'quality': quality_n}
+        self.songs_n = songs_n
+        self.rng = random.Random(seed)
+        self.reset()
+
+    def reset(self) -> None:
+        """Starts a new epoch."""
+        self.sums = {} # Sums of every scalar over steps
+        self.step_n = 0
+        # Rows correspond to true labels, columns are predicted
+        self.confusions = {kind: None for kind in self.class_ns}
+        self.songs = [] # The reservoir of song dicts
+        self.offered_n = 0 # Songs offered to the reservoir
+
+    def add_scalars(self, scalars: Dict[str, torch.Tensor]) -> None:
+        """Adds the scalars of one step."""
+        for (key, value) in scalars.items():
+            self.sums[key] = self.sums.get(key, 0.0) + value.detach()
+        self.step_n += 1
+
+    def means(self, keys: List[str]) -> Dict[str, torch.Tensor]:
+        """Means over the steps of the scalars with the given keys."""
+        return {key: self.sums[key] / self.step_n for key in keys if key in self.sums}
+
+    def add_confusion(self, kind: str, true: torch.Tensor, pred: torch.Tensor) -> None:
+        """Counts pairs of true and predicted classes of 'root' or 'quality' into the confusion."""
+        class_n = self.class_ns[kind]
+        counts = torch.bincount((true * class_n + pred).flatten(), minlength=class_n * class_n)
+        counts = counts.reshape(class_n, class_n)
+
+        if self.confusions[kind] is None:
+            self.confusions[kind] = counts
+        else:
+            self.confusions[kind] += counts
+
+    def confusion(self, kind: str) -> torch.Tensor:
+        """class_n x class_n counts of true (rows) and predicted (columns) classes."""
+        if self.confusions[kind] is None:
+            class_n = self.class_ns[kind]
+            return torch.zeros((class_n, class_n), dtype=torch.long)
+        return self.confusions[kind]
+
+    def offer_song(self, make_song: Callable[[], Dict[str, Any]]) -> None:
+        """Offers a song to the reservoir. make_song builds its dict only if it is sampled."""
+        self.offered_n += 1
+        if len(self.songs) < self.songs_n:
+            self.songs.append(make_song())
+            return
+
+        slot = self.rng.randrange(self.offered_n)
+        if slot < self.songs_n:
+            self.songs[slot] = make_song()
@@ -1,11 +1,15 @@
 import pychord
+import numpy as np
 
-from typing import List
+from typing import List, Tuple
 
 PADDED = -1
 NO_ENCODING = -2
+CONTEXT = -3 # Context beats of a training chunk, seen by the model but not scored
 
 class Chord():
+    __slots__ = ('root', 'quality', 'no_encoding')
+
     def __init__(self, root: int, quality: int):
         """Creates a chord capable of representing a MIREX annotation.
 
@@ -32,11 +36,17 @@ class Chord():
 
     @staticmethod
     def create_from_string(string, encoding):
+        return Chord(*encoding.string_to_chord(string))
+
+    @staticmethod
+    def parse_string(string, encoding) -> Tuple[int, int]:
+        """(root, quality) of a chord string, parsed with pychord. See
+        ChordEncoding.string_to_chord for the memoized lookup."""
         if string == 'X':
-            return Chord.create_no_encoding()
+            return Chord.create_no_encoding().to_tuple()
 
         if string == 'N':
-            return Chord.create_no_chord(encoding)
+            return Chord.create_no_chord(encoding).to_tuple()
 
         string = Chord.to_pychord_string(string)
 
@@ -47,16 +57,10 @@ class Chord():
         quality = Chord.from_pychord_string(quality)
 
         quality = encoding.quality_to_int(quality)
-        return Chord(root, quality)
+        return (root, quality)
 
     def notes(self, encoding):
-        if self.root == NO_ENCODING or encoding.int_to_quality(self.quality) == 'N':
-            return []
-
-        chord = pychord.Chord(Chord.to_pychord_string(self.string_encoding(encoding)))
-        notes = chord.components(visible=False)
-        notes = [n + 3 for n in notes] # pychord makes C the 0 note, we want A
-        return notes
+        return list(encoding.chord_notes(self.root, self.quality))
 
     def is_valid(self):
         return not self.no_encoding
@@ -65,13 +69,7 @@ class Chord():
         return (self.root, self.quality)
 
     def string_encoding(self, encoding):
-        if self.root == NO_ENCODING:
-            return 'X'
-
-        if encoding.int_to_quality(self.quality) == 'N':
-            return 'N'
-
-        return encoding.int_to_note(self.root) + encoding.int_to_quality(self.quality)
+        return encoding.chord_string(self.root, self.quality)
 
     @staticmethod
     def to_pychord_string(chord: str):
@@ -86,9 +84,67 @@ class Chord():
 
 class ChordEncoding():
     def __init__(self, roots: List[str], qualities: List[str]):
+        """Numbers roots and qualities, and tabulates every encoded chord.
+
+        The tables turn chord conversions on hot paths into indexing instead of pychord parses:
+            strings: root_n x quality_n nested list of the chord strings.
+            string_chords: maps the chord strings (and 'X') to (root, quality). Other spellings
+                are parsed once with pychord and memoized.
+            notes: root_n x quality_n nested list of tuples of the chord's notes, numbered from
+                C of the lowest octave as in pychord plus 3, so A is 0 modulo 12.
+            note_masks: root_n x quality_n int array, bit n set if note n (A=0) is in the chord.
+        """
         self.roots = roots
         self.qualities = qualities
 
+        self.strings = [[roots[root] + qualities[quality] if qualities[quality] != 'N' else 'N'
+                         for quality in range(len(qualities))] for root in range(len(roots))]
+
+        self.string_chords = {'X': (NO_ENCODING, NO_ENCODING)}
+        for (root, strings) in enumerate(self.strings):
+            for (quality, string) in enumerate(strings):
+                # The no chord 'N' has root 0, the first root it's spelled with
+                self.string_chords.setdefault(string, (root, quality))
+
+        self.notes = [[self.parse_notes(strings[quality], quality)
+                       for quality in range(len(qualities))] for strings in self.strings]
+        self.note_masks = np.array([[sum(1 << (note % 12) for note in set(notes))
+                                     for notes in root_notes] for root_notes in self.notes])
+
+    def __getstate__(self):
+        # Tables are rebuilt on unpickling, which also upgrades encodings pickled without them
+        return {'roots': self.roots, 'qualities': self.qualities}
+
+    def __setstate__(self, state):
+        ChordEncoding.__init__(self, state['roots'], state['qualities'])
+
+    def parse_notes(self, string: str, quality: int) -> Tuple[int, ...]:
+        if self.qualities[quality] == 'N':
+            return ()
+        chord = pychord.Chord(Chord.to_pychord_string(string))
+        # pychord makes C the 0 note, we want A
+        return tuple(n + 3 for n in chord.components(visible=False))
+
+    def string_to_chord(self, string: str) -> Tuple[int, int]:
+        """(root, quality) of a chord string, e.g. 'Bbmin7', 'N' or 'X'."""
+        chord = self.string_chords.get(string)
+        if chord is None:
+            chord = Chord.parse_string(string, self)
+            self.string_chords[string] = chord
+        return chord
+
+    def chord_string(self, root: int, quality: int) -> str:
+        """String of an encoded chord, 'X' for unencoded and context beats."""
+        if root == NO_ENCODING or root == CONTEXT:
+            return 'X'
+        return self.strings[root][quality]
+
+    def chord_notes(self, root: int, quality: int) -> Tuple[int, ...]:
+        """Notes of an encoded chord, see notes. Empty for unencoded chords and 'N'."""
+        if root == NO_ENCODING:
+            return ()
+        return self.notes[root][quality]
+
 
     def root_n(self) -> int:
         return len(self.roots)
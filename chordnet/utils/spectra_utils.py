@@ -0,0 +1,130 @@
+import functools
+import numpy as np
+from scipy import sparse
+import librosa
+
+from typing import Tuple
+
+A_FREQ = 440 # Hz, A above middle C
+# Sample counts of the form 2^a 3^b 5^c, about 26 per octave, up to over six minutes at 44.1 kHz
+SMOOTH_LENGTHS = np.unique([2**a * 3**b * 5**c for a in range(25) for b in range(16)
+                            for c in range(11) if 2**a * 3**b * 5**c <= 2**24])
+
+
+def window_length(samps: int) -> int:
+    """The largest 5-smooth sample count not above samps.
+
+    Windows are cut to these lengths: their DCTs are fast, windows of a song share few enough
+    lengths to be transformed in stacks, and the bin matrices of the lengths get reused. Windows
+    of at least 4000 samples lose at most 6% of their samples.
+    """
+    if samps < 1:
+        return samps
+    return int(SMOOTH_LENGTHS[np.searchsorted(SMOOTH_LENGTHS, samps, side='right') - 1])
+
+
+# Bin matrices are only built for window_length sample counts, which keeps the cache small
+@functools.lru_cache(maxsize=128)
+def bin_matrix(samps: int, f0: int, octaves: Tuple[int, ...], bin_n: int) -> sparse.csr_matrix:
+    """Sparse averaging matrix which bins a DCT power spectrum into subtones.
+
+    Row i * bin_n + j averages the DCT coefficients falling into subtone j of octaves[i]. Subtone
+    0 wraps around the octave: it covers the coefficients between A and A 1/(2Z) sharp as well as
+    those between G 1/(2Z) sharp and the next A. Bins without any coefficients are zero rows.
+
+    Arguments:
+        samps: number of samples in the transformed window (and DCT coefficients).
+        f0: sampling frequency.
+        octaves: octaves to bin relative to A440, e.g. (-3, -2, -1, 0, 1, 2).
+        bin_n: bins per octave, must be a multiple of 12.
+
+    Returns:
+        CSR matrix of shape [len(octaves) * bin_n x samps].
+    """
+    assert bin_n % 12 == 0
+    # Z:= num subtones. Subtones := number of divisions of a semitone. Z = 1 for normal binning
+    Z = bin_n // 12
+
+    rows, starts, stops = [], [], []
+    for i, octv in enumerate(octaves):
+        # Frequencies in Hz for half step pitches
+        notes = A_FREQ*2**octv*np.power(2**(1/12), np.arange(0,12+1,1))
+        # Frequencies in Hz for subtones, which define the bin boundaries
+        subtones = A_FREQ*2**octv*np.power(2**(1/12), np.arange(1/(2*Z), 12 + 1/(2*Z), 1/Z))
+        # Convert frequencies into DCT coefficient indices
+        note_is = (notes*(2*samps/f0)).astype(int)
+        subtone_is = (subtones*(2*samps/f0)).astype(int)
+
+        low_i, high_i = note_is[0], note_is[-1]
+
+        # Subtone 0 is split between the bottom and the top of the octave
+        rows += [i * bin_n, i * bin_n] + list(range(i * bin_n + 1, (i + 1) * bin_n))
+        starts += [low_i, subtone_is[-1]] + list(subtone_is[:-1])
+        stops += [subtone_is[0], high_i] + list(subtone_is[1:])
+
+    rows = np.array(rows, dtype=int)
+    # Match numpy slicing semantics: clip to the spectrum and treat reversed ranges as empty
+    starts = np.minimum(np.array(starts, dtype=int), samps)
+    stops = np.minimum(np.array(stops, dtype=int), samps)
+    lengths = np.maximum(stops - starts, 0)
+
+    counts = np.bincount(rows, weights=lengths, minlength=len(octaves) * bin_n)
+    weights = np.divide(1.0, counts[rows], out=np.zeros(len(rows)), where=counts[rows] > 0)
+
+    # Expand every (start, length) range into explicit column indices
+    range_offsets = np.cumsum(lengths) - lengths
+    cols = np.arange(lengths.sum()) - np.repeat(range_offsets - starts, lengths)
+
+    return sparse.csr_matrix(
+        (np.repeat(weights, lengths), (np.repeat(rows, lengths), cols)),
+        shape=(len(octaves) * bin_n, samps))
+
+
+def cqt_spectrogram(data, f0: int, octaves: Tuple[int, ...], bin_n: int,
+                    hop: int = 512) -> Tuple[np.ndarray, np.ndarray]:
+    """Constant-Q power spectrogram with the same octave / bin layout as bin_matrix.
+
+    Bin j of each octave is centered j / Z semitones above the octave's A.
+
+    Arguments:
+        data: mono audio samples.
+        f0: sampling frequency.
+        octaves: consecutive octaves relative to A440, e.g. (-3, -2, -1, 0, 1, 2).
+        bin_n: bins per octave, must be a multiple of 12.
+        hop: frame hop in samples.
+
+    Returns:
+        Power spectrogram of shape [frames x len(octaves) * bin_n] and the frame times in seconds.
+    """
+    assert bin_n % 12 == 0
+    assert list(octaves) == list(range(octaves[0], octaves[0] + len(octaves)))
+
+    C = librosa.cqt(np.asarray(data, dtype=np.float32), sr=f0, hop_length=hop,
+                    fmin=A_FREQ*2**octaves[0], n_bins=len(octaves) * bin_n,
+                    bins_per_octave=bin_n)
+    power = np.abs(C.T)**2
+    frame_times = librosa.frames_to_time(np.arange(power.shape[0]), sr=f0, hop_length=hop)
+
+    return power, frame_times
+
+
+def pool_frames(frames: np.ndarray, frame_times: np.ndarray, boundaries) -> np.ndarray:
+    """Averages the frames between consecutive boundaries.
+
+    Intervals shorter than a hop fall back to the nearest frame at or after their start.
+
+    Arguments:
+        frames: array of shape [frames x F].
+        frame_times: time of each frame in seconds.
+        boundaries: increasing interval boundaries in seconds, e.g. beat times.
+
+    Returns:
+        Array of shape [len(boundaries) - 1 x F].
+    """
+    frame_sums = np.concatenate((np.zeros((1, frames.shape[1])), np.cumsum(frames, axis=0)))
+
+    boundary_is = np.searchsorted(frame_times, boundaries)
+    starts = np.minimum(boundary_is[:-1], len(frames) - 1)
+    stops = np.maximum(np.minimum(boundary_is[1:], len(frames)), starts + 1)
+
+    return (frame_sums[stops] - frame_sums[starts]) / (stops - starts)[:, None]
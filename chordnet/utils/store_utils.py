@@ -0,0 +1,233 @@
+import os
+import pickle
+import sqlite3
+import contextlib
+import numpy as np
+import torch
+
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from chordnet.utils import file_utils
+
+
+class LazySequence():
+    def __init__(self, getter: Callable[[Any], Any], keys: Sequence):
+        """A read-only sequence which produces its elements on access.
+
+        Picklable if the getter is, e.g. a bound method of a FeatureStore, so it can be sent to
+        spawned DataLoader workers.
+
+        Arguments:
+            getter: maps a key to the element.
+            keys: the key of every element.
+        """
+        self.getter = getter
+        self.keys = keys
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.keys)
+        if not 0 <= index < len(self.keys):
+            raise IndexError('LazySequence index out of range')
+        return self.getter(self.keys[index])
+
+    def __len__(self):
+        return len(self.keys)
+
+
+MANIFEST_SCHEMA = """CREATE TABLE songs (
+    id INTEGER PRIMARY KEY, -- Index of the song in the store
+    song TEXT NOT NULL,
+    beat_n INTEGER NOT NULL,
+    duration REAL NOT NULL, -- Seconds of audio
+    mistiming REAL NOT NULL, -- Mean annotation mistiming as a fraction of the beat length
+    encoding TEXT NOT NULL, -- Chord encoding of the targets
+    start INTEGER NOT NULL, -- First row of the song in features.bin and targets.bin
+    metadata BLOB NOT NULL -- Pickled beats and annotations
+)"""
+
+
+class FeatureStoreWriter():
+    def __init__(self, path: str, dtype=np.float32, encoding: str = ''):
+        """Appends parsed songs to a new feature store at path, see FeatureStore.
+
+        Arguments:
+            path: directory of the store, emptied first.
+            dtype: dtype of the stored features.
+            encoding: name of the chord encoding of the targets, recorded in the manifest.
+        """
+        file_utils.create_empty_directory(path)
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.encoding = encoding
+        self.features = open(os.path.join(path, 'features.bin'), 'wb')
+        self.targets = open(os.path.join(path, 'targets.bin'), 'wb')
+        self.offsets = [0]
+        self.feature_n = None
+
+        # Written under a temporary name and moved in place on close
+        self.manifest_path = os.path.join(path, 'manifest.sqlite')
+        self.manifest = sqlite3.connect(f'{self.manifest_path}.tmp')
+        self.manifest.execute(MANIFEST_SCHEMA)
+
+    def add(self, song: str, data: Dict) -> None:
+        """Adds a song from its parsed data dict, normalizing the chromas by their maximum."""
+        chromas = np.stack(data['chromas'])
+        chromas = chromas / np.max(chromas)
+        chords = np.array(data['chords'], dtype=np.int64).reshape(-1, 2)
+        assert chromas.shape[0] == chords.shape[0]
+
+        if self.feature_n is None:
+            self.feature_n = chromas.shape[1]
+        assert chromas.shape[1] == self.feature_n
+
+        self.features.write(chromas.astype(self.dtype).tobytes())
+        self.targets.write(chords.tobytes())
+
+        # Songs parsed before durations were recorded end around their last beat
+        beats = list(data['beats'])
+        duration = data.get('duration', beats[-1] if beats else 0.0)
+        metadata = pickle.dumps({'beats': data['beats'], 'annotations': data['annotations']})
+        self.manifest.execute('INSERT INTO songs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (len(self.offsets) - 1, song, chromas.shape[0], float(duration),
+             float(data['annotation_mistiming']), self.encoding, self.offsets[-1], metadata))
+        self.offsets.append(self.offsets[-1] + chromas.shape[0])
+
+    def close(self) -> None:
+        self.features.close()
+        self.targets.close()
+        self.manifest.commit()
+        self.manifest.close()
+        os.replace(f'{self.manifest_path}.tmp', self.manifest_path)
+
+        index = {'dtype': self.dtype.str, 'feature_n': self.feature_n or 0,
+                 'offsets': np.array(self.offsets, dtype=np.int64)}
+        # The manifest and then the index are moved in place last, so an interrupted writer
+        # leaves a store which FeatureStore.exists rejects
+        file_utils.write_pickle_atomic(os.path.join(self.path, 'index.pickle'), index)
+
+
+class FeatureStore():
+    QUERY_IDS = 500 # Song ids per manifest query
+
+    def __init__(self, path: str):
+        """A consolidated on-disk store of all parsed songs.
+
+        All beats of all songs live in one contiguous feature array and one targets array, with
+        an offsets index marking where each song starts. Both arrays are memory-mapped
+        copy-on-write, so opening the store is cheap and DataLoader workers share pages.
+        Songs are selected and summarized by queries on the manifest, and only the metadata of
+        selected songs is unpickled. Pickled stores leave the memory maps behind and every
+        process, e.g. a spawned DataLoader worker, maps the arrays again on first access.
+
+        Files:
+            features.bin: beats_n x feature_n array of normalized spectra (float32 or float16).
+            targets.bin: beats_n x 2 int64 array of (root, quality) targets.
+            manifest.sqlite: songs table of per-song names, sizes, mistimings, locations and
+                pickled metadata, see MANIFEST_SCHEMA.
+            index.pickle: dtype, feature_n and song offsets.
+        """
+        with open(os.path.join(path, 'index.pickle'), 'rb') as file:
+            index = pickle.load(file)
+
+        self.path = path
+        self.offsets = index['offsets']
+        self.dtype = index['dtype']
+        self.feature_n = index['feature_n']
+        self.arrays = None # Feature and target arrays, mapped on first access
+
+    def __getstate__(self):
+        # Memory maps would be pickled as copies of the whole arrays
+        return dict(self.__dict__, arrays=None)
+
+    def data(self):
+        """The beats_n x feature_n feature array and the beats_n x 2 target array."""
+        if self.arrays is None:
+            beats_n = int(self.offsets[-1])
+            if beats_n == 0:
+                self.arrays = (np.zeros((0, self.feature_n), dtype=self.dtype),
+                               np.zeros((0, 2), dtype=np.int64))
+            else:
+                self.arrays = (
+                    np.memmap(os.path.join(self.path, 'features.bin'), mode='c',
+                              dtype=self.dtype, shape=(beats_n, self.feature_n)),
+                    np.memmap(os.path.join(self.path, 'targets.bin'), mode='c',
+                              dtype=np.int64, shape=(beats_n, 2)))
+        return self.arrays
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        # Stores from before the manifest are rebuilt
+        return os.path.exists(os.path.join(path, 'index.pickle')) and \
+               os.path.exists(os.path.join(path, 'manifest.sqlite'))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def query(self, sql: str, params=()) -> List[tuple]:
+        """Runs a query on the manifest. Connections are not kept, so forked workers are safe."""
+        path = os.path.join(self.path, 'manifest.sqlite')
+        with contextlib.closing(sqlite3.connect(path)) as manifest:
+            return manifest.execute(sql, params).fetchall()
+
+    def select(self, name_filter: str = '', max_mistiming: Optional[float] = None) -> List[int]:
+        """Ids of the songs whose name contains name_filter and which are not mistimed more
+        than max_mistiming, in store order."""
+        sql, params = 'SELECT id FROM songs WHERE instr(song, ?) > 0', [name_filter]
+        if max_mistiming is not None:
+            sql, params = sql + ' AND mistiming <= ?', params + [max_mistiming]
+        return [id for (id, ) in self.query(sql + ' ORDER BY id', params)]
+
+    def rows(self, columns: str, ids: List[int]) -> Dict[int, tuple]:
+        """Maps the songs ids to their rows of the comma separated manifest columns."""
+        rows = {}
+        # Stay below the sqlite limit on query parameters
+        for start in range(0, len(ids), self.QUERY_IDS):
+            chunk = list(ids[start:start + self.QUERY_IDS])
+            rows.update((row[0], row[1:]) for row in self.query(
+                f'SELECT id, {columns} FROM songs WHERE id IN ({",".join("?" * len(chunk))})',
+                chunk))
+        return rows
+
+    def metadatas(self, ids: List[int]) -> List[Dict]:
+        """Song name, beats, annotations and mistiming of the songs ids, in order."""
+        rows = self.rows('song, mistiming, metadata', ids)
+
+        metadatas = []
+        for id in ids:
+            song, mistiming, metadata = rows[id]
+            metadata = pickle.loads(metadata)
+            metadatas.append({'song': song, 'beats': metadata['beats'],
+                              'annotations': metadata['annotations'],
+                              'annotation_mistiming': mistiming})
+        return metadatas
+
+    def stats(self, ids: Optional[List[int]] = None) -> Dict[str, float]:
+        """Number of songs, beats and seconds of audio of the songs ids, or of all songs."""
+        if ids is None:
+            song_n, beat_n, duration = self.query(
+                'SELECT count(*), sum(beat_n), sum(duration) FROM songs')[0]
+        else:
+            rows = self.rows('beat_n, duration', ids).values()
+            song_n = len(rows)
+            beat_n, duration = sum(row[0] for row in rows), sum(row[1] for row in rows)
+        return {'song_n': song_n, 'beat_n': beat_n or 0, 'duration': duration or 0.0}
+
+    def lengths(self, ids: List[int]) -> List[int]:
+        """Beats of the songs ids, from the offsets."""
+        return np.diff(self.offsets)[list(ids)].tolist()
+
+    def signal(self, i: int) -> torch.Tensor:
+        """T x feature_n float tensor, a zero-copy view if the store is float32."""
+        signal = torch.from_numpy(self.data()[0][self.offsets[i]:self.offsets[i + 1]])
+        return signal.float()
+
+    def target(self, i: int) -> torch.Tensor:
+        """T x 2 long tensor, a zero-copy view."""
+        return torch.from_numpy(self.data()[1][self.offsets[i]:self.offsets[i + 1]])
+
+    def signals(self, indices: List[int]) -> LazySequence:
+        return LazySequence(self.signal, indices)
+
+    def targets(self, indices: List[int]) -> LazySequence:
+        return LazySequence(self.target, indices)
@@ -6,16 +6,135 @@ from scipy.io.wavfile import read
 import math
 import pywt
 from scipy import signal
+import scipy.fft
 import madmom
 from madmom.features.beats import RNNBeatProcessor, BeatTrackingProcessor, MultiModelSelectionProcessor
+from madmom.features.beats import DBNBeatTrackingProcessor
+from madmom.audio.signal import Signal
 import librosa
 import plotly.graph_objects as go
 import time
+import threading
+
+from chordnet.utils.audio_utils import Audio
+
+########################################################################################################################
+class BeatTracker():
+
+    def __init__(self, min_bpm=40, max_bpm=200, fps=100, online=True):
+        """Madmom tempo estimation and beat tracking, with the processors constructed once.
+
+        The processors hold state while processing (e.g. the RNN layers), so an instance must
+        not be shared between threads; use beat_tracker() to get one for the calling thread.
+
+        Arguments:
+            min_bpm: minimum tempo to detect.
+            max_bpm: maximum tempo to detect.
+            fps: frame rate of the beat activation function.
+            online: use the online (unidirectional) RNN beat models.
+        """
+        self.config = {'min_bpm': min_bpm, 'max_bpm': max_bpm, 'fps': fps, 'online': online}
+        self.tempo_processor = madmom.features.tempo.TempoEstimationProcessor(
+            method='acf', min_bpm=min_bpm, max_bpm=max_bpm, fps=fps)
+        self.rnn_processor = RNNBeatProcessor(online=online)
+        self.beat_processor = BeatTrackingProcessor(fps=fps, tempo_estimator=self.tempo_processor)
+
+    def track(self, audio):
+        """Detects the tempo and beats of a mono madmom Signal scaled to [-1, 1].
+
+        Returns:
+            The tempo in bpm and an array of beat times in seconds.
+        """
+        activations = self.rnn_processor(audio)
+        bpm = self.tempo_processor(activations)[0][0]
+        return bpm, self.beat_processor(activations)
+
+
+class StreamingBeatTracker():
+
+    def __init__(self, sample_rate=44100, min_bpm=40, max_bpm=200, fps=100):
+        """Causal beat tracking of live audio, fed in blocks of any size.
+
+        Every hop of 1 / fps seconds, the online RNN beat models process a frame of the most
+        recent samples, and the forward algorithm of madmom's DBN beat tracker decides whether
+        the frame is a beat. No future audio is used, so a beat is reported as soon as the hop
+        completing its frame has been fed. State is bounded: one frame of samples, less than a
+        hop of pending samples, the RNN and spectral difference states and the HMM forward
+        variables. Each instance is stateful and must only be fed by one thread.
+
+        Arguments:
+            sample_rate: sampling frequency of the fed samples, must be a multiple of fps.
+            min_bpm: minimum tempo to track.
+            max_bpm: maximum tempo to track.
+            fps: frame rate of the beat activation function.
+        """
+        assert sample_rate % fps == 0
+        self.sample_rate = sample_rate
+        self.hop_size = sample_rate // fps
+        self.frame_size = 2048 # Frame size of the online RNN models
+
+        self.rnn_processor = RNNBeatProcessor(online=True, origin='stream', num_frames=1, fps=fps)
+        self.beat_processor = DBNBeatTrackingProcessor(
+            min_bpm=min_bpm, max_bpm=max_bpm, fps=fps, online=True)
+        self.reset()
+
+    def reset(self):
+        """Starts a new stream."""
+        self.frame = np.zeros(self.frame_size, dtype=np.float32)
+        self.pending = np.zeros(0, dtype=np.float32)
+        self.first_frame = True
+
+    def process(self, block):
+        """Feeds a block of mono samples scaled to [-1, 1].
+
+        Returns:
+            Array of the beat times in seconds since the start of the stream which were detected
+            in the fed block.
+        """
+        samples = np.concatenate((self.pending, np.asarray(block, dtype=np.float32)))
+        hop_n = len(samples) // self.hop_size
+
+        beats = []
+        for i in range(hop_n):
+            hop = samples[i * self.hop_size:(i + 1) * self.hop_size]
+            self.frame[:-self.hop_size] = self.frame[self.hop_size:]
+            self.frame[-self.hop_size:] = hop
+
+            # Stateful processors start fresh on the first frame and carry over afterwards
+            activation = self.rnn_processor(Signal(self.frame, sample_rate=self.sample_rate),
+                                            reset=self.first_frame)
+            beats.extend(self.beat_processor.process_online(activation, reset=self.first_frame))
+            self.first_frame = False
+
+        self.pending = samples[hop_n * self.hop_size:]
+        return np.array(beats)
+
+    def latency(self):
+        """Longest delay in seconds between the end of a beat's hop and its report."""
+        return self.hop_size / self.sample_rate
+
+
+_thread_trackers = threading.local()
+
+def beat_tracker(**config) -> BeatTracker:
+    """The calling thread's BeatTracker for the given configuration, constructed on first use.
+
+    Worker processes each build their own trackers, and threads never share one.
+    """
+    trackers = getattr(_thread_trackers, 'trackers', None)
+    if trackers is None:
+        trackers = _thread_trackers.trackers = {}
+
+    key = tuple(sorted(config.items()))
+    if key not in trackers:
+        trackers[key] = BeatTracker(**config)
+    return trackers[key]
 
 ########################################################################################################################
 class TempoDetector():
 
     def __init__(self):
+        self.song = None #the decoded audio
         self.songData = None #the actual intensity values of the audio waveform in an array
         self.songName = None #the name of the song in question given by the user
         self.songSampleRate = None #extracted sample rate of the input MP3
@@ -23,16 +142,20 @@ class TempoDetector():
         self.startTime = 0
         self.endTime = 60
 
+    # Configuration of the madmom beat tracker used by detectBPM_RNN. The processors were always
+    # built with online="False", which is truthy, so the online (unidirectional) models are kept.
+    RNN_CONFIG = {'min_bpm': 40, 'max_bpm': 200, 'fps': 100, 'online': True}
 
-    def uploadSong(self, songName):
-        self.songName = songName
-        sampleRate, data = read(songName)
-        if len(data.shape) == 2:
-            data = data[:, 0] + data[:, 1]
 
-        data = np.array(data, dtype=np.float32)
-        self.songData = data; self.songSampleRate = sampleRate
-        self.endTime = math.floor(np.size(data) / sampleRate)
+    def uploadSong(self, song):
+        """Uploads a song, given as a file path or an already decoded audio_utils.Audio."""
+        if not isinstance(song, Audio):
+            song = Audio.read(song)
+
+        self.song = song
+        self.songName = song.name
+        self.songData = song.samples; self.songSampleRate = song.sample_rate
+        self.endTime = math.floor(np.size(song.samples) / song.sample_rate)
 
     def MP3toWAV(self, src, dst):
         """MP3 to numpy array"""
@@ -61,25 +184,23 @@ class TempoDetector():
 
         n_t_medians = signal.medfilt(beat_times, kernel_size=kernel_size)
         offset = 0.01
-        peaks = []
-
-        for i in range(len(beat_times) - 1):
-            if beat_times[i] > 0:
-                if beat_times[i] > beat_times[i - 1]:
-                    if beat_times[i] > beat_times[i + 1]:
-                        if beat_times[i] > (n_t_medians[i] + offset):
-                            peaks.append(int(beat_samples[i]))
+
+        # Local maxima above the running median; the first sample compares against the last one
+        current = beat_times[:-1]
+        is_peak = ((current > 0) & (current > np.roll(beat_times, 1)[:-1])
+                   & (current > beat_times[1:]) & (current > n_t_medians[:-1] + offset))
+        peaks = beat_samples[:-1][is_peak].astype(int).tolist()
         return peaks
 
     def detectBPM(self, method):
-        if self.songName is not None:
+        if self.songData is not None:
             bpm = None; beatPositions = None
             self.detectorMethod = method
 
             if self.detectorMethod == "RNN":
                 bpm, beatPositions = self.detectBPM_RNN(self.songData)
             elif self.detectorMethod == "SP":
-                bpm = self.detectBPM_SignalProcessing(self.songData, self.songSampleRate)
+                bpm, beatPositions = self.detectBPM_SignalProcessing(self.songData, self.songSampleRate)
             elif self.detectorMethod == "Librosa":
                 bpm = self.detectBPM_Librosa(self.songData, self.songSampleRate)
             else:
@@ -91,17 +212,12 @@ class TempoDetector():
 
     def detectBPM_RNN(self, y):
 
-        t1 = self.startTime * 1000  # Works in milliseconds
-        t2 = self.endTime * 1000 # take the first x seconds (it takes a while after 60 seconds)
-        newAudio = AudioSegment.from_wav(self.songName)
-        newAudio = newAudio[t1:t2]
-        newAudio.export('/tmp/test.wav', format="wav")  # Exports to a wav file in the current path.
-
-        tPred = madmom.features.tempo.TempoEstimationProcessor(method='acf', min_bpm=40, max_bpm=200, fps=100)
-        rnn_processor = RNNBeatProcessor(online="False")("/tmp/test.wav")
-        proc = BeatTrackingProcessor(fps=100, tempo_estimator = tPred)
-        result = tPred(rnn_processor)[0][0]
-        beatTiming = proc(rnn_processor)
+        t1 = self.startTime * self.songSampleRate
+        t2 = self.endTime * self.songSampleRate # take the first x seconds (it takes a while after 60 seconds)
+        # Feed the decoded samples to madmom directly, no re-decoding or temp file
+        newAudio = Signal(self.song.normalized()[t1:t2], sample_rate=self.songSampleRate)
+
+        result, beatTiming = beat_tracker(**self.RNN_CONFIG).track(newAudio)
         """maxSize = len(beatTiming)
         i = 0
         while i < maxSize - 1:
@@ -122,21 +238,22 @@ class TempoDetector():
         pass
 
     def detectBPM_SignalProcessing(self, y, fs):
-        cA = []
-        cD = []
-        correl = []
-        cD_sum = []
+        """Tempo and beats from the autocorrelation of a wavelet onset envelope, without madmom.
+
+        Returns:
+            The tempo in bpm and an array of beat times in seconds, or (None, None) for silence.
+        """
         levels = 4
-        max_decimation = 2 ** (levels - 1)
-        min_ndx = math.floor(60.0 / 220 * (fs / max_decimation))
-        max_ndx = math.floor(60.0 / 40 * (fs / max_decimation))
+        # The detail coefficients of every level are decimated to the rate of the last level
+        envelope_rate = fs / 2 ** levels
+        min_ndx = math.floor(60.0 / 220 * envelope_rate)
+        max_ndx = math.floor(60.0 / 40 * envelope_rate)
 
         for loop in range(0, levels):
-            cD = []
             # 1) DWT
             if loop == 0:
                 [cA, cD] = pywt.dwt(y, "db4")
-                cD_minlen = len(cD) / max_decimation + 1
+                cD_minlen = len(cD) / 2 ** (levels - 1) + 1
                 cD_sum = np.zeros(math.floor(cD_minlen))
             else:
                 [cA, cD] = pywt.dwt(cA, "db4")
@@ -152,30 +269,52 @@ class TempoDetector():
 
             # 6) Recombine the signal before ACF
             #    Essentially, each level the detail coefs (i.e. the HPF values) are concatenated to the beginning of the array
-            cD_sum = cD[0 : math.floor(cD_minlen)] + cD_sum
+            #    Depending on the song length, levels can come out a coefficient short
+            envelope_n = min(len(cD), len(cD_sum))
+            cD_sum = cD[0 : envelope_n] + cD_sum[0 : envelope_n]
 
-        if [b for b in cA if b != 0.0] == []:
+        if not np.any(cA):
             return self.no_audio_data()
 
         # Adding in the approximate data as well...
         cA = signal.lfilter([0.01], [1 - 0.99], cA)
         cA = abs(cA)
         cA = cA - np.mean(cA)
-        cD_sum = cA[0 : math.floor(cD_minlen)] + cD_sum
+        envelope_n = min(len(cA), len(cD_sum))
+        cD_sum = cA[0 : envelope_n] + cD_sum[0 : envelope_n]
 
-        # ACF
-        correl = np.correlate(cD_sum, cD_sum, "full")
-
-        midpoint = math.floor(len(correl) / 2)
-        correl_midpoint_tmp = correl[midpoint:]
-        peak_ndx = self.peakDetect(correl_midpoint_tmp[min_ndx:max_ndx])
-        if len(peak_ndx) > 1:
+        # ACF of the non-negative lags
+        correl = self.autocorrelation(cD_sum)
+        if max_ndx > len(correl):
             return self.no_audio_data()
 
-        peak_ndx_adjusted = peak_ndx[0] + min_ndx
-        bpm = 60.0 / peak_ndx_adjusted * (fs / max_decimation)
-
-        return bpm
+        peak_ndx = min_ndx + int(np.argmax(np.abs(correl[min_ndx:max_ndx])))
+        bpm = 60.0 / peak_ndx * envelope_rate
+
+        beat_ndxs = self.alignBeats(cD_sum, peak_ndx)
+        return bpm, beat_ndxs / envelope_rate
+
+    def autocorrelation(self, x):
+        """Autocorrelation of x at lags 0 to len(x) - 1, computed with zero-padded FFTs."""
+        n = len(x)
+        fft_n = scipy.fft.next_fast_len(2 * n - 1, real=True)
+        spectrum = np.fft.rfft(x, fft_n)
+        return np.fft.irfft(spectrum * np.conj(spectrum), fft_n)[:n]
+
+    def alignBeats(self, envelope, period):
+        """Indices of a beat grid with the given period, at the phase where the envelope peaks.
+
+        Every candidate phase is scored by the envelope summed over all its beats, like a comb
+        filter swept across one period.
+        """
+        beat_n = len(envelope) // period
+        if beat_n == 0:
+            return np.zeros(0, dtype=int)
+
+        comb = envelope[:beat_n * period].reshape(beat_n, period).sum(axis=0)
+        phase = int(np.argmax(comb))
+        beats = phase + period * np.arange(beat_n + 1)
+        return beats[beats < len(envelope)]
 
     def plotAudioSignalWithBeatID(self, beatTimes):
 
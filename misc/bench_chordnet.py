@@ -0,0 +1,69 @@
+import time
+import click
+import torch
+
+from chordnet.models.chordnet import ChordNet
+from chordnet.data import DataProperties
+from chordnet.utils.music_utils import BillboardMajMin7Encoding
+from chordnet.test.chordnet_test import rolled_windows
+
+import pdb
+
+
+def rolled_forward(net, x):
+    roots, qualities = net.classify(rolled_windows(net, x))
+    return roots, qualities, torch.tensor(0.0)
+
+
+def time_passes(forward, x, repeats, backward):
+    timings = []
+    for _ in range(repeats + 1):
+        start = time.perf_counter()
+        outputs = forward(x)
+        if backward:
+            sum(output.sum() for output in outputs if output.requires_grad).backward()
+        timings.append(time.perf_counter() - start)
+    # The first pass warms up the allocator and kernels
+    return min(timings[1:])
+
+
+@click.command()
+
+@click.option('--beats', default=500, help='Sequence length, about a full song.')
+@click.option('--repeats', default=5)
+@click.option('--threads', default=0, help='Torch threads, 0 keeps the default.')
+
+def bench(beats, repeats, threads):
+    """Times ChordNet.forward against the rolled reference on a full-length song.
+
+    The rolled reference applies the shared net to rolled copies of the sequence from
+    ChordNet.roll_zeros_seq, like the original implementation. The windows stage is the shared
+    net and the past / future gathering, the model stage the whole forward pass.
+    """
+    if threads > 0:
+        torch.set_num_threads(threads)
+
+    data_props = DataProperties(BillboardMajMin7Encoding(), octave_n=7, bin_n=24)
+    net = ChordNet(data_props)
+    x = torch.rand(beats, data_props.octave_n * data_props.bin_n)
+
+    with torch.no_grad():
+        roots, qualities, _ = net(x)
+        rolled_roots, rolled_qualities, _ = rolled_forward(net, x)
+    print(f'Max difference: roots {(roots - rolled_roots).abs().max().item():.3g}, '
+          f'qualities {(qualities - rolled_qualities).abs().max().item():.3g}')
+
+    stages = [('windows', lambda x: [rolled_windows(net, x)], lambda x: [net.history_windows(x)]),
+              ('model', lambda x: rolled_forward(net, x), net)]
+    for (stage, rolled_pass, gathered_pass) in stages:
+        for backward in [False, True]:
+            name = f'{stage} forward + backward' if backward else f'{stage} forward'
+            with torch.set_grad_enabled(backward):
+                rolled = time_passes(rolled_pass, x, repeats, backward)
+                gathered = time_passes(gathered_pass, x, repeats, backward)
+            print(f'{name}: rolled {rolled * 1000:.1f} ms, gathered {gathered * 1000:.1f} ms, '
+                  f'speedup {rolled / gathered:.2f}x')
+
+
+if __name__ == "__main__":
+    bench()
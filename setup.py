@@ -14,7 +14,6 @@ setup(
         'plotly',
         'librosa',
         # Harmony
-        'sklearn',
         'torchtestcase',
         'matplotlib',
         'tabulate',